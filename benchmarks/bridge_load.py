@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Load test for mcore-tcp-bridge. Starts the bridge against the simulator
+driver, then for each client count connects that many clients which do the
+signature handshake and send requests at a fixed rate, while the simulator
+pushes synthetic adverts to all of them. Reports throughput, request and push
+latency percentiles, and the bridge's CPU time and peak RSS.
+
+    PYTHONPATH=src python3 benchmarks/bridge_load.py -c 1,8,32 -r 10 -p 50 -o results.json
+    PYTHONPATH=src python3 benchmarks/bridge_load.py -c 1,8,32 -r 10 -p 50 --compare results.json
+
+--compare exits non zero when throughput drops, or p99 latency grows, by more
+than --tolerance relative to an earlier run.
+"""
+
+import argparse
+import asyncio
+import collections
+import dataclasses
+import importlib.metadata
+import json
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from asyncio import StreamReader, StreamWriter
+from pathlib import Path
+from typing import Any, Optional
+
+from meshcore.packets import CommandType
+
+from mcoreutils.framing import encode_frame, is_push, read_frame
+from mcoreutils.simulator import SYNTHETIC_TIME
+from mcoreutils.tcp_bridge import SIGNATURE
+
+HOST = "127.0.0.1"
+# answered by the simulator, never cached by the bridge
+REQUEST = bytes([CommandType.GET_DEVICE_TIME.value])
+QUANTILES = (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+
+
+@dataclasses.dataclass
+class ClientStats:
+    sent: int = 0
+    responses: int = 0
+    pushes: int = 0
+    request_latencies: list[float] = dataclasses.field(default_factory=list[float])
+    push_latencies: list[float] = dataclasses.field(default_factory=list[float])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values: list[float]):
+    values = sorted(values)
+    return {name: values[min(int(q * len(values)), len(values) - 1)] if values else None for name, q in QUANTILES}
+
+
+async def handshake(port: int) -> tuple[StreamReader, StreamWriter]:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(encode_frame(SIGNATURE, b"<"))
+    await writer.drain()
+    while True:
+        frame = await read_frame(reader)
+        if frame is None:
+            raise Exception("Bridge closed the connection during the handshake")
+        if not is_push(frame):
+            return reader, writer
+
+
+async def wait_for_bridge(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await handshake(port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise Exception(f"Bridge not listening on {port}")
+            await asyncio.sleep(0.1)
+
+
+async def run_client(port: int, rate: float, duration: float, stats: ClientStats):
+    reader, writer = await handshake(port)
+    pending = collections.deque[float]()
+
+    async def send():
+        if rate <= 0:
+            return
+        interval = 1 / rate
+        due = time.perf_counter()
+        end = due + duration
+        while due < end:
+            pending.append(time.perf_counter())
+            writer.write(encode_frame(REQUEST, b"<"))
+            stats.sent += 1
+            await writer.drain()
+            due += interval
+            await asyncio.sleep(max(due - time.perf_counter(), 0))
+
+    async def receive():
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                return
+            if is_push(frame):
+                stats.pushes += 1
+                if len(frame) >= 1 + SYNTHETIC_TIME.size:
+                    stats.push_latencies.append(time.time() - SYNTHETIC_TIME.unpack_from(frame, 1)[0])
+            elif pending:
+                stats.responses += 1
+                stats.request_latencies.append(time.perf_counter() - pending.popleft())
+
+    receiver = asyncio.create_task(receive())
+    try:
+        await asyncio.gather(send(), asyncio.sleep(duration))
+        # NOTE give outstanding responses a moment before counting them lost
+        grace = time.monotonic() + 2.0
+        while pending and time.monotonic() < grace:
+            await asyncio.sleep(0.05)
+    finally:
+        receiver.cancel()
+        writer.close()
+
+
+async def run_level(args: argparse.Namespace, clients: int) -> dict[str, Any]:
+    port = free_port()
+    bridge_config = {
+        "driver": "simulator",
+        "host": HOST,
+        "port": port,
+        "baudrate": args.baudrate,
+        "synthetic_rate": args.push_rate,
+        "synthetic_size": args.size,
+        "simulated_latency": args.latency,
+        "loglevel": "WARNING",
+    }
+    # NOTE json is valid yaml
+    with tempfile.NamedTemporaryFile("w", suffix=".yml", delete=False) as f:
+        json.dump(bridge_config, f)
+    config_path = Path(f.name)
+    # NOTE run the bridge in its own process so its cpu and memory can be measured apart from the clients
+    proc = subprocess.Popen([sys.executable, "-c", "from mcoreutils.tcp_bridge import main; main()", "-c", str(config_path)])
+    try:
+        await wait_for_bridge(port)
+        stats = [ClientStats() for _ in range(clients)]
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        await asyncio.gather(*(run_client(port, args.rate, args.duration, s) for s in stats))
+        elapsed = time.perf_counter() - start
+        self_cpu = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        # NOTE wait4 rather than getrusage(RUSAGE_CHILDREN), whose max rss spans every bridge run so far
+        _, _, usage = await asyncio.to_thread(os.wait4, proc.pid, 0)
+        proc.returncode = 0
+        config_path.unlink()
+
+    sent = sum(s.sent for s in stats)
+    responses = sum(s.responses for s in stats)
+    pushes = sum(s.pushes for s in stats)
+    return {
+        "clients": clients,
+        "duration": elapsed,
+        "requests_sent": sent,
+        "responses_received": responses,
+        "responses_lost": sent - responses,
+        "pushes_received": pushes,
+        "frames_per_sec": (responses + pushes) / elapsed,
+        "responses_per_sec": responses / elapsed,
+        "request_latency": percentiles([latency for s in stats for latency in s.request_latencies]),
+        "push_latency": percentiles([latency for s in stats for latency in s.push_latencies]),
+        # NOTE includes the bridge starting up and shutting down
+        "bridge_cpu_seconds": usage.ru_utime + usage.ru_stime,
+        "bridge_max_rss_bytes": usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        # NOTE if this nears the duration the clients, not the bridge, are the bottleneck
+        "client_cpu_seconds": (self_cpu.ru_utime + self_cpu.ru_stime) - (self_usage.ru_utime + self_usage.ru_stime),
+    }
+
+
+def version():
+    try:
+        return importlib.metadata.version("mcoreutils")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def ms(value: Optional[float]):
+    return "-" if value is None else f"{value * 1000:.2f}"
+
+
+def report(result: dict[str, Any]):
+    request_latency = result["request_latency"]
+    push_latency = result["push_latency"]
+    print(
+        f"{result['clients']:>5} clients"
+        f" {result['frames_per_sec']:>10,.0f} frames/sec"
+        f" {result['responses_per_sec']:>8,.0f} resp/sec"
+        f" lost {result['responses_lost']:>4}"
+        f" req ms p50/p99/p999 {ms(request_latency['p50'])}/{ms(request_latency['p99'])}/{ms(request_latency['p999'])}"
+        f" push ms p50/p99/p999 {ms(push_latency['p50'])}/{ms(push_latency['p99'])}/{ms(push_latency['p999'])}"
+        f" cpu {result['bridge_cpu_seconds']:.2f}s"
+        f" rss {result['bridge_max_rss_bytes'] / (1 << 20):.1f}MiB"
+    )
+
+
+def compare(results: list[dict[str, Any]], baseline: dict[str, Any], tolerance: float):
+    """
+    Regressions against a baseline run, matched by client count.
+    """
+    regressions: list[str] = []
+    base_results = {e["clients"]: e for e in baseline["results"]}
+    for result in results:
+        base = base_results.get(result["clients"])
+        if base is None:
+            continue
+        clients = result["clients"]
+        if result["frames_per_sec"] < base["frames_per_sec"] * (1 - tolerance):
+            regressions.append(f"{clients} clients: frames_per_sec {result['frames_per_sec']:,.0f} < {base['frames_per_sec']:,.0f}")
+        for key in ("request_latency", "push_latency"):
+            p99, base_p99 = result[key]["p99"], base[key]["p99"]
+            if p99 is not None and base_p99 is not None and p99 > base_p99 * (1 + tolerance):
+                regressions.append(f"{clients} clients: {key} p99 {ms(p99)}ms > {ms(base_p99)}ms")
+    return regressions
+
+
+async def amain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", metavar="clients", default="1,4,16,64", help="comma separated client counts")
+    parser.add_argument("-r", dest="rate", metavar="rate", type=float, default=10.0, help="requests/sec per client")
+    parser.add_argument("-p", dest="push_rate", metavar="push_rate", type=float, default=50.0, help="pushes/sec to every client")
+    parser.add_argument("-d", dest="duration", metavar="duration", type=float, default=10.0, help="seconds per client count")
+    parser.add_argument("-s", dest="size", metavar="push_size", type=int, default=33)
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated device latency in seconds")
+    parser.add_argument("--baudrate", type=int, default=115200)
+    parser.add_argument("-o", metavar="output_path", type=Path, help="write results as json")
+    parser.add_argument("--compare", metavar="baseline_path", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results: list[dict[str, Any]] = []
+    for clients in [int(e) for e in args.c.split(",")]:
+        result = await run_level(args, clients)
+        report(result)
+        results.append(result)
+
+    output = {
+        "version": version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "params": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "results": results,
+    }
+    if args.o is not None:
+        args.o.write_text(json.dumps(output, indent=2) + "\n")
+    if args.compare is not None:
+        regressions = compare(results, json.loads(args.compare.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the event codec, comparing the original json.dumps and
+json.loads calls against mcoreutils.common's jdump/jload and the binary
+record format.
+
+    PYTHONPATH=src python3 benchmarks/codec.py -n 20000
+"""
+
+import argparse
+import io
+import json
+import time
+from typing import Any, Callable
+
+from meshcore import EventType
+from meshcore.events import Event
+
+from mcoreutils.common import JSONEncoder, bdump, bload, jdump, jload, object_hook, read_records
+
+
+def legacy_jdump(o: Any):
+    return json.dumps(o, cls=JSONEncoder)
+
+
+def legacy_jload(o: Any):
+    return json.loads(o, object_hook=object_hook)
+
+
+def message_event():
+    payload = {
+        "type": "PRIV",
+        "pubkey_prefix": "0123456789ab",
+        "path_len": 3,
+        "txt_type": 0,
+        "sender_timestamp": 1700000000,
+        "text": "hello there, how are you doing",
+        "SNR": 6.25,
+        "signature": bytes(range(4)),
+    }
+    return Event(EventType.CONTACT_MSG_RECV, payload, {"pubkey_prefix": "0123456789ab", "txt_type": 0})
+
+
+def contacts_event(count: int):
+    contacts = {
+        f"{i:064x}": {
+            "public_key": f"{i:064x}",
+            "type": 1,
+            "flags": 0,
+            "out_path_len": -1,
+            "out_path": "",
+            "adv_name": f"node{i}",
+            "last_advert": 1700000000 + i,
+            "adv_lat": 47.6 + i / 1000,
+            "adv_lon": -122.3 - i / 1000,
+            "lastmod": 1700000000 + i,
+        }
+        for i in range(count)
+    }
+    return Event(EventType.CONTACTS, contacts, {"lastmod": 1700000000 + count})
+
+
+def bench(fn: Callable[[Any], Any], o: Any, n: int):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn(o)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", metavar="iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, event, n in (("message", message_event(), args.n), ("300 contacts", contacts_event(300), max(args.n // 200, 1))):
+        text = legacy_jdump(event)
+        # NOTE the fast path must stay byte compatible with the original
+        assert jdump(event) == text
+        assert jload(text) == legacy_jload(text)
+        record = bdump(event)
+        assert bload(record) == event
+        assert list(read_records(io.BytesIO(record * 3))) == [event] * 3
+        print(f"{name}: json {len(text)} bytes, binary {len(record)} bytes")
+        results = [
+            ("encode legacy", bench(legacy_jdump, event, n)),
+            ("encode jdump", bench(jdump, event, n)),
+            ("encode bdump", bench(bdump, event, n)),
+            ("decode legacy", bench(legacy_jload, text, n)),
+            ("decode jload", bench(jload, text, n)),
+            ("decode bload", bench(bload, record, n)),
+        ]
+        for label, per_sec in results:
+            print(f"  {label:<14} {per_sec:>12,.0f} events/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the bridge framing hot path, comparing the original three
+writes per frame and read(n) parsing against mcoreutils.framing.
+
+    PYTHONPATH=src python3 benchmarks/framing.py -n 100000 -c 4
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import time
+from asyncio import StreamReader, StreamWriter
+from typing import Awaitable, Callable, Optional
+
+from mcoreutils.framing import encode_frame, read_frame
+
+
+def legacy_write(writers: list[StreamWriter], frame: bytes):
+    for data in (b"?", len(frame).to_bytes(2, byteorder="little"), frame):
+        for writer in writers:
+            writer.write(data)
+
+
+def framed_write(writers: list[StreamWriter], frame: bytes):
+    data = encode_frame(frame)
+    for writer in writers:
+        writer.write(data)
+
+
+async def legacy_read_frame(reader: StreamReader):
+    byte0 = await reader.read(1)
+    if not byte0:
+        return None
+    data_sz_bytes = await reader.read(2)
+    if not data_sz_bytes:
+        return None
+    data_sz = int.from_bytes(data_sz_bytes, byteorder="little")
+    data = await reader.read(data_sz)
+    if not data:
+        return None
+    return data
+
+
+async def drain_socket(sock: socket.socket, expected: int):
+    loop = asyncio.get_running_loop()
+    received = 0
+    while received < expected:
+        data = await loop.sock_recv(sock, 1 << 16)
+        if not data:
+            break
+        received += len(data)
+
+
+async def bench_write(write: Callable[[list[StreamWriter], bytes], None], *, frames: int, clients: int, payload: bytes):
+    writers: list[StreamWriter] = []
+    sinks: list[socket.socket] = []
+    for _ in range(clients):
+        a, b = socket.socketpair()
+        b.setblocking(False)
+        _, writer = await asyncio.open_connection(sock=a)
+        writers.append(writer)
+        sinks.append(b)
+    expected = frames * (len(payload) + 3)
+    drains = [asyncio.create_task(drain_socket(sink, expected)) for sink in sinks]
+    start = time.perf_counter()
+    for i in range(frames):
+        write(writers, payload)
+        if i % 256 == 0:
+            await asyncio.gather(*(writer.drain() for writer in writers))
+    await asyncio.gather(*(writer.drain() for writer in writers))
+    await asyncio.gather(*drains)
+    elapsed = time.perf_counter() - start
+    for writer in writers:
+        writer.close()
+    for sink in sinks:
+        sink.close()
+    return frames / elapsed
+
+
+async def bench_read(read: Callable[[StreamReader], Awaitable[Optional[bytes]]], *, frames: int, payload: bytes):
+    reader = StreamReader(limit=1 << 24)
+    reader.feed_data(bytes(encode_frame(payload, b"<")) * frames)
+    reader.feed_eof()
+    start = time.perf_counter()
+    count = 0
+    while await read(reader) is not None:
+        count += 1
+    elapsed = time.perf_counter() - start
+    assert count == frames, count
+    return frames / elapsed
+
+
+async def amain():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", metavar="frames", type=int, default=50000)
+    parser.add_argument("-c", metavar="clients", type=int, default=4)
+    parser.add_argument("-s", metavar="payload_size", type=int, default=64)
+    args = parser.parse_args()
+
+    payload = os.urandom(args.s)
+    results = [
+        ("write legacy", await bench_write(legacy_write, frames=args.n, clients=args.c, payload=payload)),
+        ("write framed", await bench_write(framed_write, frames=args.n, clients=args.c, payload=payload)),
+        ("read legacy", await bench_read(legacy_read_frame, frames=args.n, payload=payload)),
+        ("read framed", await bench_read(read_frame, frames=args.n, payload=payload)),
+    ]
+    for name, frames_per_sec in results:
+        print(f"{name:<14} {frames_per_sec:>12,.0f} frames/sec")
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for contact distance queries, comparing mcoreutils.geo's grid
+index against a haversine over every contact, and checking they agree.
+
+    PYTHONPATH=src python3 benchmarks/geo.py -n 100000
+"""
+
+import argparse
+import math
+import random
+import time
+from typing import Any
+
+from mcoreutils.geo import EARTH_RADIUS_KM, GridIndex
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(h, 1.0)))
+
+
+def contacts(count: int) -> dict[str, dict[str, Any]]:
+    random.seed(0)
+    # NOTE half clustered around one city, as real networks are
+    return {
+        f"{i:064x}": {
+            "adv_lat": random.gauss(47.6, 0.5) if i % 2 else random.uniform(-80, 80),
+            "adv_lon": random.gauss(-122.3, 0.5) if i % 2 else random.uniform(-180, 180),
+            "type": 2,
+        }
+        for i in range(count)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", metavar="contacts", type=int, default=100000)
+    parser.add_argument("-q", metavar="queries", type=int, default=20)
+    args = parser.parse_args()
+    if args.q < 1:
+        parser.error("-q must be at least 1")
+
+    data = contacts(args.n)
+    start = time.perf_counter()
+    index = GridIndex.build(data)
+    print(f"build {len(index)} contacts {(time.perf_counter() - start) * 1000:.1f}ms")
+    positions = [(contact["adv_lat"], contact["adv_lon"], key) for key, contact in data.items()]
+    for label, lat, lon, radius in (("city 25km", 47.6, -122.3, 25.0), ("rural 500km", 10.0, 20.0, 500.0)):
+        found = list[tuple[float, int]]()
+        scanned = list[str]()
+        start = time.perf_counter()
+        for _ in range(args.q):
+            found = index.within(lat, lon, radius)
+        indexed = (time.perf_counter() - start) / args.q
+        start = time.perf_counter()
+        for _ in range(args.q):
+            scanned = [key for p_lat, p_lon, key in positions if haversine(lat, lon, p_lat, p_lon) <= radius]
+        scan = (time.perf_counter() - start) / args.q
+        assert sorted(index.keys[i] for _, i in found) == sorted(scanned)
+        print(f"{label}: {len(found)} contacts, index {indexed * 1000:.2f}ms, scan {scan * 1000:.2f}ms")
+    start = time.perf_counter()
+    for _ in range(args.q):
+        index.nearest(47.6, -122.3, 10)
+    print(f"nearest 10: {(time.perf_counter() - start) / args.q * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Startup guard for mcore-cli. For each common command, runs fresh
+interpreters with -X importtime that import mcoreutils.main and parse the
+command line, everything mcore-cli does before connecting, and reports the
+import time and wall time. Exits non zero if a module that should only load
+for other commands was imported, or import time is over --budget or grew by
+more than --tolerance relative to an earlier run.
+
+    PYTHONPATH=src python3 benchmarks/startup.py -o startup.json
+    PYTHONPATH=src python3 benchmarks/startup.py --compare startup.json --budget 300
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+COMMANDS = (
+    ("self-info",),
+    ("send-msg", "-n", "alice", "-m", "hi"),
+    ("send-chan-msg", "--channel-idx", "0", "-m", "hi"),
+    ("get-contacts",),
+    ("subscribe", "-t", "contact_msg_recv"),
+)
+# only create-map and mcore-grpc-server need these
+LAZY_MODULES = ("folium", "branca", "jinja2", "grpc")
+CHILD = "import sys; from mcoreutils.main import build_parser; build_parser().parse_args(sys.argv[1:])"
+
+
+def parse_importtime(stderr: str):
+    """
+    Cumulative microseconds per top level import, and every module imported.
+    """
+    top = dict[str, int]()
+    modules = set[str]()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        modules.add(name.strip())
+        # NOTE nested imports are indented under their importer
+        if not name.startswith("  "):
+            top[name.strip()] = int(cumulative)
+    return top, modules
+
+
+def measure(command: tuple[str, ...], runs: int) -> dict[str, Any]:
+    import_times: list[float] = []
+    wall_times: list[float] = []
+    top = dict[str, int]()
+    modules = set[str]()
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD, *command], capture_output=True, text=True)
+        wall_times.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise Exception(f"{' '.join(command)} failed: {proc.stderr.splitlines()[-1:]}")
+        top, modules = parse_importtime(proc.stderr)
+        import_times.append(sum(top.values()) / 1e6)
+    return {
+        "command": " ".join(command),
+        # NOTE medians, the first run pays for a cold page cache
+        "import_seconds": statistics.median(import_times),
+        "wall_seconds": statistics.median(wall_times),
+        "slowest": sorted(top.items(), key=lambda e: e[1], reverse=True)[:5],
+        "lazy_imported": sorted(m for m in modules if m.split(".")[0] in LAZY_MODULES),
+    }
+
+
+def compare(results: list[dict[str, Any]], baseline: dict[str, Any], tolerance: float):
+    regressions: list[str] = []
+    base_results = {e["command"]: e for e in baseline["results"]}
+    for result in results:
+        base = base_results.get(result["command"])
+        if base is not None and result["import_seconds"] > base["import_seconds"] * (1 + tolerance):
+            regressions.append(f"{result['command']}: import {result['import_seconds'] * 1000:.0f}ms > {base['import_seconds'] * 1000:.0f}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", metavar="runs", type=int, default=5, help="interpreters started per command")
+    parser.add_argument("--budget", metavar="ms", type=float, help="fail if any command's import time is over this")
+    parser.add_argument("-o", metavar="output_path", type=Path, help="write results as json")
+    parser.add_argument("--compare", metavar="baseline_path", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    failures: list[str] = []
+    results: list[dict[str, Any]] = []
+    for command in COMMANDS:
+        result = measure(command, args.n)
+        results.append(result)
+        slowest = ", ".join(f"{name} {us / 1000:.0f}ms" for name, us in result["slowest"])
+        print(f"{result['command']:<40} import {result['import_seconds'] * 1000:>6.1f}ms wall {result['wall_seconds'] * 1000:>6.1f}ms ({slowest})")
+        if result["lazy_imported"]:
+            failures.append(f"{result['command']}: imported {', '.join(result['lazy_imported'][:5])}")
+        if args.budget is not None and result["import_seconds"] * 1000 > args.budget:
+            failures.append(f"{result['command']}: import {result['import_seconds'] * 1000:.0f}ms over budget {args.budget:.0f}ms")
+
+    if args.o is not None:
+        args.o.write_text(json.dumps({"python": sys.version, "time": time.time(), "results": results}, indent=2) + "\n")
+    if args.compare is not None:
+        failures.extend(compare(results, json.loads(args.compare.read_text()), args.tolerance))
+    for failure in failures:
+        print(f"failure: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import asyncio
+import collections
+import json
+import logging
+import math
+import time
+from typing import Any
+
+from meshcore import EventType, MeshCore
+from meshcore.events import Event
+from meshcore.packets import CommandType
+
+from mcoreutils.common import TokenBucket
+
+# LoRa preamble symbols, RadioLib's default
+PREAMBLE_SYMBOLS = 8
+# mesh packet bytes around a message's ciphertext, header, path length,
+# destination and source hashes and mac, or for a channel its hash and mac
+MESSAGE_OVERHEAD = 6
+CHANNEL_OVERHEAD = 4
+CIPHER_BLOCK = 16
+# meshcore's own retries wait this much longer than the device suggests
+ACK_TIMEOUT_FACTOR = 1.2
+
+
+def lora_airtime(size: int, *, sf: int, bw: float, cr: int, preamble: int = PREAMBLE_SYMBOLS):
+    """
+    Seconds on air for a LoRa packet of size bytes at spreading factor sf,
+    bandwidth bw kHz and coding rate 4/cr, with an explicit header and crc,
+    per Semtech's AN1200.13.
+    """
+    symbol = (1 << sf) / (bw * 1000)
+    low_data_rate = 2 if symbol > 0.016 else 0
+    payload_symbols = 8 + max(math.ceil((8 * size - 4 * sf + 44) / (4 * (sf - low_data_rate))) * cr, 0)
+    return (preamble + 4.25 + payload_symbols) * symbol
+
+
+def message_size(text: str, overhead: int):
+    # NOTE timestamp and flags, then the text, encrypted in whole blocks
+    return overhead + math.ceil((5 + len(text.encode())) / CIPHER_BLOCK) * CIPHER_BLOCK
+
+
+class AirtimeLimiter:
+    """
+    Paces transmissions to duty_cycle of the radio's time, with up to burst
+    seconds on air at once, estimating each packet's airtime from the
+    device's radio settings. A device that doesn't report them, such as the
+    simulator, isn't paced.
+    """
+
+    def __init__(self, self_info: dict[str, Any], *, duty_cycle: float, burst: float):
+        self.sf = self_info.get("radio_sf", 0)
+        self.bw = self_info.get("radio_bw", 0)
+        self.cr = self_info.get("radio_cr", 0)
+        self.bucket = TokenBucket(duty_cycle, burst) if duty_cycle > 0 else None
+
+    def airtime(self, size: int):
+        if not (self.sf and self.bw and self.cr):
+            return 0.0
+        return lora_airtime(size, sf=self.sf, bw=self.bw, cr=self.cr)
+
+    async def acquire(self, size: int):
+        seconds = self.airtime(size)
+        if self.bucket is not None and seconds > 0:
+            await self.bucket.acquire(seconds)
+        return seconds
+
+
+class Pipeline:
+    """
+    Raw commands over one connection with up to window waiting on the
+    device, which answers in order, so a response belongs to the oldest
+    command still waiting. Only for commands answered by exactly one of
+    response_types, with nothing else sending meanwhile. A timeout leaves no
+    way to tell which command a late response is for, so it fails every
+    request still waiting and every one after it too.
+    """
+
+    def __init__(
+        self,
+        meshcore: MeshCore,
+        *,
+        window: int,
+        timeout: float,
+        response_types: tuple[EventType, ...] = (EventType.MSG_SENT, EventType.OK, EventType.ERROR),
+    ):
+        self.meshcore = meshcore
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(window)
+        self.waiting = collections.deque[asyncio.Future[Event]]()
+        self.broken = False
+        self.subscriptions = [
+            meshcore.dispatcher.subscribe(event_type, self.callback) for event_type in response_types  # pyright: ignore [reportUnknownMemberType]
+        ]
+
+    def callback(self, event: Event):
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_result(event)
+                return
+        logging.debug(f"Unexpected response {event.type}")
+
+    async def request(self, data: bytes) -> Event:
+        async with self.slots:
+            if self.broken:
+                raise Exception("Lost track of device responses after a timeout")
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.append(future)
+            try:
+                await self.meshcore.commands.send(data)
+            except Exception:
+                # NOTE never written, so no response is coming for it
+                self.waiting.remove(future)
+                raise
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except TimeoutError:
+                self.fail()
+                raise Exception("Timed out waiting for the device")
+
+    def fail(self):
+        """
+        Fail every request still waiting, as the late response would be
+        taken for the next one's.
+        """
+        self.broken = True
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_exception(Exception("Lost track of device responses after a timeout"))
+
+    def close(self):
+        for subscription in self.subscriptions:
+            subscription.unsubscribe()
+
+
+class AckTracker:
+    """
+    Acks by the code MSG_SENT said to expect. An ack can be dispatched right
+    behind its MSG_SENT, before the sender gets to expect it, so acks nobody
+    expects yet are kept, up to max_early of them.
+    """
+
+    def __init__(self, meshcore: MeshCore, max_early: int = 1000):
+        self.waiting = dict[str, asyncio.Future[Event]]()
+        self.early = collections.OrderedDict[str, Event]()
+        self.max_early = max_early
+        self.subscription = meshcore.dispatcher.subscribe(EventType.ACK, self.callback)  # pyright: ignore [reportUnknownMemberType]
+
+    def callback(self, event: Event):
+        code = event.attributes.get("code", "")
+        future = self.waiting.pop(code, None)
+        if future is None:
+            self.early[code] = event
+            if len(self.early) > self.max_early:
+                self.early.popitem(last=False)
+        elif not future.done():
+            future.set_result(event)
+
+    def expect(self, code: str, future: asyncio.Future[Event]):
+        event = self.early.pop(code, None)
+        if event is None:
+            self.waiting[code] = future
+        elif not future.done():
+            future.set_result(event)
+
+    def forget(self, codes: list[str]):
+        for code in codes:
+            self.waiting.pop(code, None)
+
+    def close(self):
+        self.subscription.unsubscribe()
+
+
+def timestamp_bytes(timestamp: int):
+    return timestamp.to_bytes(4, byteorder="little")
+
+
+async def send_msg(
+    pipeline: Pipeline,
+    acks: AckTracker,
+    limiter: AirtimeLimiter,
+    public_key: str,
+    text: str,
+    *,
+    attempts: int,
+) -> dict[str, Any]:
+    """
+    Send text until it's acked, up to attempts times, each waiting as long
+    as the device suggests. An ack for any attempt counts.
+    """
+    # NOTE the same timestamp every attempt, the attempt number tells receivers it's a retry
+    timestamp = timestamp_bytes(int(time.time()))
+    destination = bytes.fromhex(public_key)[:6]
+    size = message_size(text, MESSAGE_OVERHEAD)
+    acked = asyncio.get_running_loop().create_future()
+    codes = list[str]()
+    airtime = 0.0
+    try:
+        for attempt in range(attempts):
+            airtime += await limiter.acquire(size)
+            data = bytes([CommandType.SEND_TXT_MSG.value, 0, attempt]) + timestamp + destination + text.encode()
+            sent = await pipeline.request(data)
+            if sent.type != EventType.MSG_SENT:
+                raise Exception(f"Unable to send message: {sent.payload}")
+            codes.append(sent.attributes["expected_ack"])
+            acks.expect(codes[-1], acked)
+            try:
+                ack = await asyncio.wait_for(asyncio.shield(acked), sent.payload["suggested_timeout"] / 1000 * ACK_TIMEOUT_FACTOR)
+            except TimeoutError:
+                logging.debug(f"No ack from {public_key[:12]} for attempt {attempt + 1}")
+                continue
+            return {
+                "public_key": public_key,
+                "attempts": attempt + 1,
+                "flood": sent.payload["type"] == 1,
+                "trip_time": ack.payload.get("trip_time"),
+                "airtime": round(airtime, 3),
+            }
+        raise Exception(f"No ack after {attempts} attempts")
+    finally:
+        acks.forget(codes)
+
+
+async def send_chan_msg(pipeline: Pipeline, limiter: AirtimeLimiter, channel_idx: int, text: str, *, sender: str) -> dict[str, Any]:
+    # NOTE the device sends the text prefixed with its name
+    airtime = await limiter.acquire(message_size(f"{sender}: {text}", CHANNEL_OVERHEAD))
+    data = bytes([CommandType.SEND_CHANNEL_TXT_MSG.value, 0, channel_idx]) + timestamp_bytes(int(time.time())) + text.encode()
+    result = await pipeline.request(data)
+    if result.type == EventType.ERROR:
+        raise Exception(f"Unable to send channel message: {result.payload}")
+    return {"channel_idx": channel_idx, "airtime": round(airtime, 3)}
+
+
+async def import_contact(pipeline: Pipeline, uri: str) -> dict[str, Any]:
+    meshcore_uri_prefix = "meshcore://"
+    if not uri.startswith(meshcore_uri_prefix):
+        raise Exception(f"Not a meshcore uri: {uri}")
+    result = await pipeline.request(bytes([CommandType.IMPORT_CONTACT.value]) + bytes.fromhex(uri[len(meshcore_uri_prefix) :]))
+    if result.type == EventType.ERROR:
+        raise Exception(f"Unable to import contact: {result.payload}")
+    return {"uri": uri}
+
+
+def parse_item(line: str) -> tuple[Any, Any]:
+    """
+    (id, item) for an input line, a json object with an optional id to echo
+    back, or plain text.
+    """
+    if line.startswith("{"):
+        item = json.loads(line)
+        return item.get("id"), item
+    return None, line
@@ -0,0 +1,62 @@
+import asyncio
+import mmap
+import struct
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+MAGIC = b"MCAP\x01\x00\x00\x00"
+# timestamp, direction, payload size, followed by the payload
+RECORD = struct.Struct("<dBH")
+# frame from the device
+FROM_DEVICE = 0
+# frame to the device
+TO_DEVICE = 1
+
+
+class CaptureWriter:
+    """
+    Appends frames to a capture file, buffered, so capturing stays cheap on
+    the bridge hot path.
+    """
+
+    def __init__(self, path: Path, buffer_size: int = 64 * 1024):
+        new = not path.exists() or path.stat().st_size == 0
+        self.file = path.open("ab", buffering=buffer_size)
+        if new:
+            self.file.write(MAGIC)
+
+    def write(self, direction: int, frame: bytes, timestamp: Optional[float] = None):
+        self.file.write(RECORD.pack(time.time() if timestamp is None else timestamp, direction, len(frame)))
+        self.file.write(frame)
+
+    async def run(self, interval: float = 1.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path: Path) -> Iterator[tuple[float, int, bytes]]:
+    """
+    (timestamp, direction, frame) for each record. The file is mapped rather
+    than read, so large captures aren't loaded into memory. A truncated last
+    record, from a bridge that didn't shut down cleanly, is ignored.
+    """
+    with path.open("rb") as f:
+        if path.stat().st_size < len(MAGIC):
+            raise Exception(f"Not a capture: {path}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[: len(MAGIC)] != MAGIC:
+                raise Exception(f"Not a capture: {path}")
+            offset = len(MAGIC)
+            size = len(m)
+            while offset + RECORD.size <= size:
+                timestamp, direction, frame_sz = RECORD.unpack_from(m, offset)
+                offset += RECORD.size
+                if offset + frame_sz > size:
+                    break
+                yield timestamp, direction, m[offset : offset + frame_sz]
+                offset += frame_sz
@@ -1,8 +1,17 @@
+import asyncio
 import json
-from typing import Any
+import logging
+import marshal
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Any, Awaitable, BinaryIO, Callable, Iterator, Optional, TypeVar
 
 from meshcore.events import Event, EventType
 
+T = TypeVar("T")
+
 
 def object_hook(data: Any):
     if "_type" in data:
@@ -53,13 +62,199 @@ class PrettyJSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+# NOTE events are never circular, and checking costs a dict entry per container
+ENCODER = JSONEncoder(check_circular=False)
+DECODER = json.JSONDecoder(object_hook=object_hook)
+# NOTE the tagged Event and EventType wrapping JSONEncoder produces, rendered
+# once per type, so only the payload and attributes go through the encoder
+EVENT_START = '{"_type": "Event", "value": {"type": {"_type": "EventType", "value": "'
+EVENT_PAYLOAD = '"}, "payload": '
+EVENT_ATTRIBUTES = ', "attributes": '
+EVENT_PREFIXES = {event_type: EVENT_START + event_type.name + EVENT_PAYLOAD for event_type in EventType}
+EVENT_TYPES = {event_type.name: event_type for event_type in EventType}
+
+
 def jdump(o: Any):
-    return json.dumps(o, cls=JSONEncoder)
+    if type(o) is Event:
+        return EVENT_PREFIXES[o.type] + ENCODER.encode(o.payload) + ', "attributes": ' + ENCODER.encode(o.attributes) + "}}"
+    return ENCODER.encode(o)
 
 
 def jout(o: Any):
     print(json.dumps(o, cls=PrettyJSONEncoder, indent=2))
 
 
-def jload(o: Any):
-    return json.loads(o, object_hook=object_hook)
+def jload_event(o: str) -> Optional[Event]:
+    """
+    An Event as jdump writes one, taken apart around its payload and
+    attributes, so object_hook only sees the dicts in them rather than the
+    envelope too. None for anything else.
+    """
+    end = o.find('"', len(EVENT_START))
+    event_type = EVENT_TYPES.get(o[len(EVENT_START) : end])
+    if event_type is None or not o.startswith(EVENT_PAYLOAD, end):
+        return None
+    start = end + len(EVENT_PAYLOAD)
+    payload, end = DECODER.raw_decode(o, start)
+    if not o.startswith(EVENT_ATTRIBUTES, end):
+        return None
+    attributes, end = DECODER.raw_decode(o, end + len(EVENT_ATTRIBUTES))
+    if o[end:].rstrip() != "}}":
+        return None
+    return Event(event_type, payload, attributes)
+
+
+def jload(o: Any) -> Any:
+    if isinstance(o, (bytes, bytearray)):
+        o = o.decode()
+    # NOTE nothing tagged, so skip calling object_hook for every dict
+    if "_type" not in o:
+        return json.loads(o)
+    if o.startswith(EVENT_START) and (event := jload_event(o)) is not None:
+        return event
+    return DECODER.decode(o)
+
+
+# binary records, a kind byte and uint32 length and then a marshal body.
+# Events are (type name, payload, attributes), and their payloads keep bytes
+# and non-string dict keys rather than hex and strings.
+RECORD_HEADER = struct.Struct("<BI")
+RECORD_EVENT = 0x45  # E
+RECORD_OBJECT = 0x4F  # O
+# NOTE pinned, so records read back on later pythons
+MARSHAL_VERSION = 4
+
+
+def bdump(o: Any):
+    """
+    One length prefixed binary record of an Event or of plain data, None,
+    bools, numbers, strings, bytes and containers of them.
+    """
+    if type(o) is Event:
+        kind = RECORD_EVENT
+        body = marshal.dumps((o.type.name, o.payload, o.attributes), MARSHAL_VERSION)
+    else:
+        kind = RECORD_OBJECT
+        body = marshal.dumps(o, MARSHAL_VERSION)
+    return RECORD_HEADER.pack(kind, len(body)) + body
+
+
+def bload_body(kind: int, body: bytes) -> Any:
+    if kind == RECORD_EVENT:
+        name, payload, attributes = marshal.loads(body)
+        return Event(EventType[name], payload, attributes)
+    elif kind == RECORD_OBJECT:
+        return marshal.loads(body)
+    raise Exception(f"Unknown record kind: {kind:#x}")
+
+
+def bload(record: bytes):
+    kind, size = RECORD_HEADER.unpack_from(record)
+    return bload_body(kind, record[RECORD_HEADER.size : RECORD_HEADER.size + size])
+
+
+def read_records(f: BinaryIO) -> Iterator[Any]:
+    """
+    The records bdump wrote to f, read one at a time. A record cut short at
+    the end, as a writer killed mid-write leaves, is skipped. Like pickle,
+    only read records from a trusted source.
+    """
+    while header := f.read(RECORD_HEADER.size):
+        body = b""
+        if len(header) == RECORD_HEADER.size:
+            kind, size = RECORD_HEADER.unpack(header)
+            body = f.read(size)
+            if len(body) == size:
+                yield bload_body(kind, body)
+                continue
+        logging.warning(f"Skipping a truncated record, {len(header) + len(body)} bytes at the end")
+        return
+
+
+async def run_lines(
+    parse: Callable[[str], tuple[Any, T]],
+    handle: Callable[[T], Awaitable[dict[str, Any]]],
+    *,
+    input_path: Optional[Path] = None,
+    concurrency: int = 1,
+):
+    """
+    handle each line of input_path, or stdin, parsed into (id, item), with
+    up to concurrency in progress, writing one ndjson result per line in
+    completion order: its index, id if any, ok and handle's fields or the
+    error. Blank lines and # comments are skipped. Returns the number that
+    failed.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def run(index: int, line: str):
+        nonlocal failed
+        result: dict[str, Any] = {"index": index}
+        try:
+            _id, item = parse(line)
+            if _id is not None:
+                result["id"] = _id
+            outcome = await handle(item)
+            result["ok"] = True
+            result.update(outcome)
+        except Exception as e:
+            failed += 1
+            result["ok"] = False
+            result["error"] = str(e)
+        finally:
+            semaphore.release()
+        print(jdump(result), flush=True)
+
+    input_file = sys.stdin if input_path is None else input_path.open()
+    try:
+        async with asyncio.TaskGroup() as g:
+            index = 0
+            while True:
+                # NOTE read as lines are taken, so a slow producer can feed the run
+                await semaphore.acquire()
+                line = await asyncio.to_thread(input_file.readline)
+                if not line:
+                    semaphore.release()
+                    break
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    semaphore.release()
+                    continue
+                g.create_task(run(index, line))
+                index += 1
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+    return failed
+
+
+class TokenBucket:
+    """
+    Refills at rate tokens per second up to capacity. Requests larger than the
+    capacity wait for a full bucket and leave it in debt.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, n: float = 1):
+        self.refill()
+        return max(0.0, (min(n, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, n: float = 1):
+        self.refill()
+        self.tokens -= n
+
+    async def acquire(self, n: float = 1):
+        while (delay := self.delay(n)) > 0:
+            await asyncio.sleep(delay)
+        self.take(n)
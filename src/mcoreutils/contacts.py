@@ -0,0 +1,85 @@
+import os
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import platformdirs
+from meshcore import EventType, MeshCore
+
+from mcoreutils.common import jdump, jload
+
+default_cache_path = platformdirs.user_cache_path("mcoreutils")
+
+
+class ContactStore:
+    """
+    A device's contacts persisted under the cache directory, keyed by the
+    device's public key, so commands needn't download the whole contact table
+    every run. Syncs are incremental from the device's lastmod, which doesn't
+    report removals, so a contact removed by another client lingers until a
+    refresh.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lastmod = 0
+        self.synced_at = 0.0
+        self.contacts = dict[str, dict[str, Any]]()
+        # adv_name.lower() -> public_key
+        self.names = dict[str, str]()
+
+    @staticmethod
+    def open(cache_path: Path, device_public_key: str):
+        store = ContactStore(cache_path / "contacts" / f"{device_public_key}.json")
+        store.load()
+        return store
+
+    def load(self):
+        try:
+            data = jload(self.path.read_text())
+        except FileNotFoundError:
+            return
+        self.lastmod = data["lastmod"]
+        self.synced_at = data["synced_at"]
+        self.contacts = data["contacts"]
+        self.index()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE replace rather than rewrite, so a concurrent reader never sees half a file
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(jdump({"lastmod": self.lastmod, "synced_at": self.synced_at, "contacts": self.contacts}))
+        os.replace(tmp_path, self.path)
+
+    def index(self):
+        # NOTE case insensitive with the first of any duplicates winning, as meshcore's get_contact_by_name
+        self.names = dict[str, str]()
+        for public_key, contact in self.contacts.items():
+            self.names.setdefault(contact.get("adv_name", "").lower(), public_key)
+
+    def stale(self, max_age: float):
+        return time.time() - self.synced_at > max_age
+
+    def get_by_name(self, name: str) -> Optional[dict[str, Any]]:
+        public_key = self.names.get(name.lower())
+        return None if public_key is None else self.contacts[public_key]
+
+    async def sync(self, meshcore: MeshCore, *, refresh: bool = False):
+        """
+        Fetch contacts changed since the last sync, or all of them on refresh.
+        """
+        event = await meshcore.commands.get_contacts(lastmod=0 if refresh else self.lastmod)
+        if event.type == EventType.ERROR:
+            raise Exception(f"Unable to get contacts: {event.payload}")
+        if refresh:
+            self.contacts = {}
+        self.contacts.update(event.payload)
+        self.lastmod = event.attributes.get("lastmod", self.lastmod)
+        self.synced_at = time.time()
+        self.index()
+        self.save()
+
+    def remove(self, public_key: str):
+        if self.contacts.pop(public_key, None) is not None:
+            self.index()
+            self.save()
@@ -0,0 +1,101 @@
+import json
+import operator
+import re
+from types import CodeType
+from typing import Any, Callable, Optional, cast
+
+from meshcore import EventType
+from meshcore.events import Event
+
+# longest first, so >= isn't read as >
+PREDICATE_RE = re.compile(r"^([\w.]+)(!=|>=|<=|=|~|>|<)(.*)$")
+ORDERINGS: dict[str, Callable[[Any, Any], bool]] = {
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+}
+MISSING = object()
+
+
+def lookup(payload: object, path: tuple[str, ...]) -> object:
+    value = payload
+    for key in path:
+        if not isinstance(value, dict):
+            return MISSING
+        value = cast(dict[str, object], value).get(key, MISSING)
+    return value
+
+
+def compile_predicate(expression: str) -> Callable[[Any], bool]:
+    """
+    field=value, field!=value, field~regex or field>number (>, <, >=, <=)
+    against an event payload, field being a dotted path into it. value is
+    taken as json when it parses, so numbers and booleans compare as such,
+    and otherwise as a string.
+    """
+    match = PREDICATE_RE.match(expression)
+    if match is None:
+        raise Exception(f"Invalid predicate: {expression}")
+    field, op, raw = match.groups()
+    path = tuple(field.split("."))
+    if op == "~":
+        pattern = re.compile(raw)
+        return lambda payload: (value := lookup(payload, path)) is not MISSING and pattern.search(str(value)) is not None
+    if op in ORDERINGS:
+        compare = ORDERINGS[op]
+        number = float(raw)
+
+        def ordered(payload: Any):
+            value = lookup(payload, path)
+            return isinstance(value, (int, float)) and compare(value, number)
+
+        return ordered
+    typed: object
+    try:
+        typed = json.loads(raw)
+    except ValueError:
+        typed = raw
+    # NOTE a string field matches the raw text too, so prefix=1234 finds "1234"
+    if op == "=":
+        return lambda payload: (value := lookup(payload, path)) == typed or value == raw
+    return lambda payload: (value := lookup(payload, path)) is not MISSING and value != typed and value != raw
+
+
+class EventFilter:
+    """
+    Which events to keep: any of event_types, with every predicate holding on
+    the payload and the compiled expression, if any, true. The event types
+    are meant for subscribing to the dispatcher, so events of other types
+    never reach matches at all.
+    """
+
+    def __init__(
+        self,
+        event_types: Optional[frozenset[EventType]] = None,
+        predicates: Optional[list[Callable[[Any], bool]]] = None,
+        expression: Optional[CodeType] = None,
+    ):
+        self.event_types = event_types
+        self.predicates = predicates if predicates is not None else []
+        self.expression = expression
+
+    @staticmethod
+    def compile(*, event_types: Optional[list[str]] = None, where: Optional[list[str]] = None, xfilter: Optional[str] = None):
+        types: Optional[frozenset[EventType]] = None
+        if event_types:
+            unknown = [name for name in event_types if name.upper() not in EventType.__members__]
+            if unknown:
+                raise Exception(f"Unknown event types: {', '.join(unknown)}")
+            types = frozenset(EventType[name.upper()] for name in event_types)
+        predicates = [compile_predicate(e) for e in where] if where else None
+        expression = compile(xfilter, "<xfilter>", "eval") if xfilter else None
+        return EventFilter(types, predicates, expression)
+
+    def matches(self, event: Event):
+        for predicate in self.predicates:
+            if not predicate(event.payload):
+                return False
+        if self.expression is not None:
+            return bool(eval(self.expression, None, {"event": event, "EventType": EventType}))
+        return True
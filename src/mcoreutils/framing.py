@@ -0,0 +1,67 @@
+import struct
+from asyncio import IncompleteReadError, StreamReader
+from typing import Optional
+
+from meshcore.packets import CommandType, PacketType
+
+# marker byte, little endian payload size
+HEADER = struct.Struct("<cH")
+HEADER_SZ = HEADER.size
+# device to client frames start with >, which newer meshcore clients look for
+OUT_MARKER = b">"
+# device frames at or above this are unsolicited pushes rather than responses
+PUSH_CODE_MIN = 0x80
+# responses that end a get_contacts stream, every other command is answered by one frame
+CONTACTS_FINAL_CODES = frozenset([PacketType.CONTACT_END.value, PacketType.ERROR.value])
+# mcore-tcp-bridge's own command, answered by the bridge and never written to
+# the device: code, then the last count frames or the last seconds of them
+BACKFILL = 0xFE
+BACKFILL_COUNT = 0
+BACKFILL_SECONDS = 1
+BACKFILL_REQUEST = struct.Struct("<BBI")
+
+
+def is_push(frame: bytes):
+    return not frame or frame[0] >= PUSH_CODE_MIN
+
+
+def is_final_response(command: int, frame: bytes):
+    return command != CommandType.GET_CONTACTS.value or frame[0] in CONTACTS_FINAL_CODES
+
+
+def backfill_request(*, count: Optional[int] = None, seconds: Optional[int] = None):
+    """
+    A command asking mcore-tcp-bridge for the pushes it had kept when the
+    client connected, the last count of them or those from the last
+    seconds, answered with the pushes then OK once the client's earlier
+    commands have been answered.
+    """
+    if (count is None) == (seconds is None):
+        raise Exception("Need one of count or seconds")
+    if count is not None:
+        return BACKFILL_REQUEST.pack(BACKFILL, BACKFILL_COUNT, count)
+    return BACKFILL_REQUEST.pack(BACKFILL, BACKFILL_SECONDS, seconds)
+
+
+def encode_frame(payload: bytes, marker: bytes = OUT_MARKER) -> bytearray:
+    """
+    Build a complete frame in one preallocated buffer, so it can be handed to
+    every client as a single write.
+    """
+    frame = bytearray(HEADER_SZ + len(payload))
+    HEADER.pack_into(frame, 0, marker, len(payload))
+    frame[HEADER_SZ:] = payload
+    return frame
+
+
+async def read_frame(reader: StreamReader) -> Optional[bytes]:
+    """
+    Read one frame, None on eof. Unlike read(n), readexactly never returns a
+    partial frame on a busy link.
+    """
+    try:
+        header = await reader.readexactly(HEADER_SZ)
+        _, data_sz = HEADER.unpack(header)
+        return await reader.readexactly(data_sz)
+    except IncompleteReadError:
+        return None
@@ -0,0 +1,162 @@
+import math
+from array import array
+from typing import Any, Optional
+
+# mean earth radius
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+# contact types as the device reports them
+CONTACT_TYPES = {"chat": 1, "repeater": 2, "room": 3, "sensor": 4}
+
+
+def contact_type(name: str):
+    if name.isdigit():
+        return int(name)
+    if name not in CONTACT_TYPES:
+        raise Exception(f"Unknown contact type: {name}")
+    return CONTACT_TYPES[name]
+
+
+def located(contact: dict[str, Any]):
+    lat = contact.get("adv_lat")
+    lon = contact.get("adv_lon")
+    if lat is None or lon is None:
+        return None
+    lat, lon = float(lat), float(lon)
+    # NOTE 0,0 is what a device without a position advertises
+    if (lat == 0 and lon == 0) or not (-90 <= lat <= 90 and -180 <= lon <= 180) or math.isnan(lat) or math.isnan(lon):
+        return None
+    return lat, lon
+
+
+class GridIndex:
+    """
+    Located contacts bucketed into cells of cell_size degrees. Positions are
+    kept in flat arrays ordered by cell, so a cell is a slice of them, with
+    radians and cos(lat) precomputed for the haversine. Queries only visit
+    the cells overlapping their bounding box.
+    """
+
+    def __init__(self, cell_size: float = 0.1):
+        self.cell_size = cell_size
+        self.columns = math.ceil(360 / cell_size)
+        self.keys = list[str]()
+        self.lats = array("d")
+        self.lons = array("d")
+        self.lat_rads = array("d")
+        self.lon_rads = array("d")
+        self.cos_lats = array("d")
+        # (row, column) -> (start, end) into the arrays
+        self.cells = dict[tuple[int, int], tuple[int, int]]()
+
+    def cell(self, lat: float, lon: float):
+        return math.floor(lat / self.cell_size), math.floor((lon + 180) / self.cell_size) % self.columns
+
+    @staticmethod
+    def build(contacts: dict[str, dict[str, Any]], *, types: Optional[frozenset[int]] = None, cell_size: float = 0.1):
+        index = GridIndex(cell_size)
+        points = list[tuple[tuple[int, int], str, float, float]]()
+        for public_key, contact in contacts.items():
+            if types is not None and contact.get("type") not in types:
+                continue
+            position = located(contact)
+            if position is not None:
+                points.append((index.cell(*position), public_key, *position))
+        points.sort()
+        for i, (cell, public_key, lat, lon) in enumerate(points):
+            start, _ = index.cells.get(cell, (i, i))
+            index.cells[cell] = (start, i + 1)
+            index.keys.append(public_key)
+            index.lats.append(lat)
+            index.lons.append(lon)
+            index.lat_rads.append(math.radians(lat))
+            index.lon_rads.append(math.radians(lon))
+            index.cos_lats.append(math.cos(math.radians(lat)))
+        return index
+
+    def __len__(self):
+        return len(self.keys)
+
+    def candidates(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+        """
+        Slices of the arrays for cells overlapping the box, which wraps
+        the antimeridian when min_lon > max_lon.
+        """
+        min_row, min_column = self.cell(min_lat, min_lon)
+        max_row, max_column = self.cell(max_lat, max_lon)
+        span = (max_column - min_column) % self.columns
+        if max_lon - min_lon >= 360 or (span == 0 and min_lon > max_lon):
+            columns = range(self.columns)
+        else:
+            columns = [(min_column + i) % self.columns for i in range(span + 1)]
+        # NOTE scan the cells themselves when the box covers most of the grid
+        if (max_row - min_row + 1) * len(columns) > len(self.cells):
+            column_set = set(columns)
+            return [(start, end) for (row, column), (start, end) in self.cells.items() if min_row <= row <= max_row and column in column_set]
+        slices = list[tuple[int, int]]()
+        for row in range(min_row, max_row + 1):
+            for column in columns:
+                found = self.cells.get((row, column))
+                if found is not None:
+                    slices.append(found)
+        return slices
+
+    def in_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float):
+        """
+        Indexes of positions in the box.
+        """
+        wraps = min_lon > max_lon
+        lats, lons = self.lats, self.lons
+        found = list[int]()
+        for start, end in self.candidates(min_lat, min_lon, max_lat, max_lon):
+            for i in range(start, end):
+                lat, lon = lats[i], lons[i]
+                if min_lat <= lat <= max_lat and ((min_lon <= lon or lon <= max_lon) if wraps else min_lon <= lon <= max_lon):
+                    found.append(i)
+        return found
+
+    def within(self, lat: float, lon: float, radius_km: float):
+        """
+        (distance in km, index) of positions within radius_km, nearest first.
+        """
+        dlat = radius_km / KM_PER_DEGREE
+        min_lat, max_lat = max(lat - dlat, -90.0), min(lat + dlat, 90.0)
+        edge = max(abs(min_lat), abs(max_lat))
+        if edge >= 90 or dlat >= 180:
+            min_lon, max_lon = -180.0, 180.0
+        else:
+            dlon = min(dlat / math.cos(math.radians(edge)), 180.0)
+            min_lon, max_lon = lon - dlon, lon + dlon
+            if dlon >= 180:
+                min_lon, max_lon = -180.0, 180.0
+            elif min_lon < -180:
+                min_lon += 360
+            elif max_lon > 180:
+                max_lon -= 360
+        lat_rad, lon_rad, cos_lat = math.radians(lat), math.radians(lon), math.cos(math.radians(lat))
+        # NOTE compare against the haversine term rather than the distance, so only matches take an asin
+        limit = math.sin(min(radius_km / EARTH_RADIUS_KM, math.pi) / 2) ** 2
+        lat_rads, lon_rads, cos_lats = self.lat_rads, self.lon_rads, self.cos_lats
+        sin = math.sin
+        found = list[tuple[float, int]]()
+        for start, end in self.candidates(min_lat, min_lon, max_lat, max_lon):
+            for i in range(start, end):
+                h = sin((lat_rads[i] - lat_rad) / 2) ** 2 + cos_lat * cos_lats[i] * sin((lon_rads[i] - lon_rad) / 2) ** 2
+                if h <= limit:
+                    found.append((2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(h, 1.0))), i))
+        found.sort()
+        return found
+
+    def nearest(self, lat: float, lon: float, count: int, radius_km: Optional[float] = None):
+        """
+        (distance in km, index) of the count positions nearest, within
+        radius_km if given, nearest first. Searches a widening radius, as
+        every position within a radius holding count of them is a candidate.
+        """
+        limit = math.pi * EARTH_RADIUS_KM if radius_km is None else radius_km
+        radius = min(self.cell_size * KM_PER_DEGREE, limit)
+        while True:
+            found = self.within(lat, lon, radius)
+            if len(found) >= count or radius >= limit:
+                return found[:count]
+            radius = min(radius * 4, limit)
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import logging
+import signal
+from asyncio import CancelledError
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, cast
+
+import grpc
+from meshcore import MeshCore, EventType
+from meshcore.events import Event
+
+from mcoreutils.common import jdump, jload
+from mcoreutils.filters import EventFilter
+from mcoreutils.main import CommandParser, Config, build_parser, create_meshcore, default_config_path, load_config, run_command
+
+SERVICE = "mcoreutils.MeshCore"
+# mcore-cli commands served as unary rpcs, named in CamelCase, send-msg as SendMsg
+UNARY_COMMANDS = (
+    "self-info",
+    "reboot",
+    "get-contacts",
+    "contacts-near",
+    "contacts-in-bbox",
+    "remove-contact",
+    "send-msg",
+    "get-msg",
+    "get-channel",
+    "get-channels",
+    "send-chan-msg",
+    "set-channel",
+    "remove-channel",
+    "export-contact",
+    "import-contact",
+    "send-advert",
+)
+
+
+def method_name(command: str):
+    return "".join(word.capitalize() for word in command.split("-"))
+
+
+class RequestParser(CommandParser):
+    """
+    Without -h, so a request's h or help is an unknown argument rather than
+    a request for usage.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **{**kwargs, "add_help": False})
+
+
+def request_argv(command: str, request: Any) -> list[str]:
+    """
+    mcore-cli arguments for a request object, single letter keys as -k and
+    the rest as --key-name, true as a bare flag and a list as the flag
+    repeated. So send-msg takes {"n": "alice", "m": "hello"} and
+    get-channel {"channel_idx": 3}.
+    """
+    if not isinstance(request, dict):
+        raise Exception("Request must be a json object")
+    argv = [command]
+    for key, value in cast(dict[str, Any], request).items():
+        if key == "refresh":
+            # NOTE a global option, so it goes before the command
+            if value:
+                argv.insert(0, "--refresh")
+            continue
+        flag = f"-{key}" if len(key) == 1 else f"--{key.replace('_', '-')}"
+        if value is None or value is False:
+            continue
+        # NOTE flag=value, so a value starting with - isn't taken for an option
+        if value is True:
+            argv.append(flag)
+        elif isinstance(value, list):
+            argv.extend(f"{flag}={e}" for e in cast(list[Any], value))
+        else:
+            argv.append(f"{flag}={value}")
+    return argv
+
+
+class Subscriber:
+    """
+    Encoded events waiting for one stream. A subscriber that falls behind
+    loses its oldest events, not the newest, and is told how many.
+    """
+
+    def __init__(self, event_filter: EventFilter, queue_size: int):
+        self.event_filter = event_filter
+        self.queue = asyncio.Queue[bytes](maxsize=queue_size)
+        self.dropped = 0
+
+    def put(self, frame: bytes):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(frame)
+
+
+class EventHub:
+    """
+    Fans events from one dispatcher subscription out to every subscriber,
+    indexed by event type so an event only visits the subscribers that
+    asked for it, and encoded at most once however many of them match.
+    """
+
+    def __init__(self):
+        self.by_type = dict[EventType, set[Subscriber]]()
+        # subscribers to every event type
+        self.wildcard = set[Subscriber]()
+
+    def add(self, subscriber: Subscriber):
+        if subscriber.event_filter.event_types is None:
+            self.wildcard.add(subscriber)
+        else:
+            for event_type in subscriber.event_filter.event_types:
+                self.by_type.setdefault(event_type, set()).add(subscriber)
+
+    def remove(self, subscriber: Subscriber):
+        self.wildcard.discard(subscriber)
+        for event_type in subscriber.event_filter.event_types or ():
+            subscribers = self.by_type.get(event_type)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.by_type[event_type]
+
+    def publish(self, event: Event):
+        subscribers = self.by_type.get(event.type)
+        if subscribers is None and not self.wildcard:
+            return
+        frame: Optional[bytes] = None
+        for subscriber in [*(subscribers or ()), *self.wildcard]:
+            if not subscriber.event_filter.matches(event):
+                continue
+            if frame is None:
+                try:
+                    frame = jdump(event).encode()
+                except Exception as e:
+                    # NOTE connected carries an unresolved future
+                    logging.debug(f"Unable to encode {event.type}: {e}")
+                    return
+            subscriber.put(frame)
+
+
+class Servicer:
+    def __init__(self, config: Config, meshcore: MeshCore):
+        self.config = config
+        self.meshcore = meshcore
+        self.parser = build_parser(RequestParser)
+        # NOTE meshcore matches responses by type alone, so two commands in flight could swap them
+        self.command_lock = asyncio.Lock()
+        self.hub = EventHub()
+        self.subscription = meshcore.dispatcher.subscribe(None, self.hub.publish)  # pyright: ignore [reportUnknownMemberType]
+
+    async def get_meshcore(self):
+        return self.meshcore
+
+    async def subscribe(self, request: Any, context: grpc.aio.ServicerContext[Any, Any]) -> AsyncIterator[bytes]:
+        """
+        Events as they arrive, each a jdump encoded Event, filtered by a
+        request of {"event_types": [...], "where": [...]} as for subscribe.
+        """
+        try:
+            if not isinstance(request, dict):
+                raise Exception("Request must be a json object")
+            data = cast(dict[str, Any], request)
+            event_filter = EventFilter.compile(event_types=data.get("event_types"), where=data.get("where"))
+        except Exception as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+            raise
+        subscriber = Subscriber(event_filter, self.config.grpc_queue_size)
+        self.hub.add(subscriber)
+        logging.info(f"Subscriber {context.peer()} connected")
+        try:
+            while True:
+                frame = await subscriber.queue.get()
+                if subscriber.dropped:
+                    logging.warning(f"Subscriber {context.peer()} dropped {subscriber.dropped} events, it is falling behind")
+                    subscriber.dropped = 0
+                yield frame
+        finally:
+            self.hub.remove(subscriber)
+            logging.info(f"Subscriber {context.peer()} disconnected")
+
+    def command(self, command: str) -> Callable[[Any, grpc.aio.ServicerContext[Any, Any]], Awaitable[bytes]]:
+        async def handler(request: Any, context: grpc.aio.ServicerContext[Any, Any]):
+            try:
+                args = self.parser.parse_args(request_argv(command, request))
+            except Exception as e:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+                raise
+            try:
+                async with self.command_lock:
+                    result = await run_command(self.config, args, self.get_meshcore)
+            except Exception as e:
+                logging.debug(f"{command} failed: {e}")
+                await context.abort(grpc.StatusCode.UNKNOWN, str(e))
+                raise
+            return jdump(result).encode()
+
+        return handler
+
+    def handler(self):
+        handlers: dict[str, grpc.RpcMethodHandler[Any, Any]] = {
+            "Subscribe": grpc.unary_stream_rpc_method_handler(self.subscribe, request_deserializer=jload),
+            **{method_name(command): grpc.unary_unary_rpc_method_handler(self.command(command), request_deserializer=jload) for command in UNARY_COMMANDS},
+        }
+        return grpc.method_handlers_generic_handler(SERVICE, handlers)
+
+    def close(self):
+        self.subscription.unsubscribe()
+
+
+def serialize(o: Any):
+    return jdump(o).encode()
+
+
+class Client:
+    """
+    Calls a mcore-grpc-server, with requests and results as for mcore-cli.
+    """
+
+    def __init__(self, channel: grpc.aio.Channel):
+        self.channel = channel
+
+    async def call(self, command: str, **kwargs: Any) -> Any:
+        method: grpc.aio.UnaryUnaryMultiCallable[Any, Any] = self.channel.unary_unary(
+            f"/{SERVICE}/{method_name(command)}", request_serializer=serialize, response_deserializer=jload
+        )
+        return await method(kwargs)
+
+    async def subscribe(self, *, event_types: Optional[list[str]] = None, where: Optional[list[str]] = None) -> AsyncIterator[Event]:
+        method: grpc.aio.UnaryStreamMultiCallable[Any, Any] = self.channel.unary_stream(
+            f"/{SERVICE}/Subscribe", request_serializer=serialize, response_deserializer=jload
+        )
+        async for event in method({"event_types": event_types, "where": where}):
+            yield event
+
+
+async def amain():
+    logging.basicConfig(level=logging.INFO)
+
+    main_task = asyncio.current_task()
+    assert main_task is not None
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, main_task.cancel)
+    loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", metavar="config_path", type=Path, default=default_config_path)
+    parser.add_argument("-d", action="store_true", help="enable debug")
+    parser.add_argument("-l", metavar="listen", help="Address to listen on, host:port")
+    args = parser.parse_args()
+
+    config = load_config(args.c, debug=args.d)
+    logging.root.setLevel(config.loglevel)
+    logging.debug(config)
+    listen = args.l or config.grpc_listen
+
+    meshcore = await create_meshcore(config)
+    servicer = Servicer(config, meshcore)
+    server = grpc.aio.server()
+    server.add_generic_rpc_handlers((servicer.handler(),))
+    if server.add_insecure_port(listen) == 0:
+        raise Exception(f"Unable to listen on {listen}")
+    await server.start()
+    logging.info(f"Listening on {listen}")
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(grace=1.0)
+        servicer.close()
+        await meshcore.disconnect()
+
+
+def main():
+    try:
+        asyncio.run(amain())
+    except CancelledError:
+        logging.info("Cancelled")
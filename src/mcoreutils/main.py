@@ -3,17 +3,28 @@ import argparse
 import asyncio
 import dataclasses
 import enum
+import json
 import logging
+import os
+import shlex
+import sys
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Awaitable, Callable, Optional
 
-import folium
 import platformdirs
 import yaml
 from meshcore import MeshCore, EventType
 from meshcore.events import Event
+from meshcore.packets import CommandType
 
-from mcoreutils.common import jout
+from mcoreutils import bulk
+from mcoreutils.common import jout, run_lines
+from mcoreutils.contacts import ContactStore, default_cache_path
+from mcoreutils.filters import EventFilter
+from mcoreutils.framing import backfill_request
+from mcoreutils.geo import GridIndex, contact_type
+from mcoreutils.maps import MAP_FORMATS, contact_positions, write_map
+from mcoreutils.output import NDJSONWriter, RecordWriter, RotatingFileSink, StdoutSink
 
 default_config_path = platformdirs.user_config_path("mcoreutils.yaml")
 default_mc_endpoint = (
@@ -21,6 +32,8 @@ default_mc_endpoint = (
     1234,
 )
 MAX_CHANNEL_IDX = 40
+# commands that never finish, read their own input or would nest
+UNBATCHABLE_COMMANDS = frozenset(["subscribe", "batch", "bulk-send-msg", "bulk-send-chan-msg", "bulk-import-contact"])
 
 
 class MeshCoreDriver(enum.Enum):
@@ -35,6 +48,29 @@ class Config:
     mc_endpoint: tuple[str, int] = default_mc_endpoint
     loglevel: int = logging.INFO
     subscribe_resolve_event: bool = True
+    # events waiting to be written, past this the newest are dropped
+    subscribe_queue_size: int = 10000
+    cache_path: Path = default_cache_path
+    # seconds cached contacts are used before syncing changes from the device
+    contacts_max_age: float = 300.0
+    # channel requests in flight when fetching the channel table, meshcore's
+    # tcp connection gives up after 5 unanswered
+    channel_window: int = 4
+    channel_timeout: float = 5.0
+    # mcore-grpc-server's address, and events waiting per subscriber, past
+    # which the oldest are dropped
+    grpc_listen: str = "localhost:50051"
+    grpc_queue_size: int = 1000
+    # create-map clusters markers in the browser past this many positions
+    map_cluster_threshold: int = 1000
+    # bulk commands waiting on the device at once, under meshcore's limit of 5
+    bulk_window: int = 4
+    bulk_timeout: float = 10.0
+    msg_attempts: int = 3
+    # fraction of the time bulk sends may keep the radio transmitting, and
+    # the seconds of airtime they may use in a burst
+    airtime_duty_cycle: float = 0.1
+    airtime_burst: float = 5.0
 
     @staticmethod
     def from_data(data: dict[str, Any]):
@@ -47,23 +83,90 @@ class Config:
             kwargs["serial_device_path"] = Path(data["serial_device_path"])
         if "driver" in data:
             kwargs["driver"] = MeshCoreDriver(data["driver"])
+        if "cache_path" in data:
+            kwargs["cache_path"] = Path(data["cache_path"])
         return Config(**kwargs)
 
 
-async def create_map(meshcore: MeshCore, *, output_path: Path):
-    assert await meshcore.ensure_contacts()
-    contacts = meshcore.contacts
-    m = folium.Map(zoom_start=4)
-    for contact_info in contacts.values():
-        adv_name = contact_info["adv_name"]
-        adv_lat = contact_info["adv_lat"]
-        adv_lon = contact_info["adv_lon"]
-        folium.CircleMarker(
-            [float(adv_lat), float(adv_lon)],
-            popup=adv_name,
-            radius=4,
-        ).add_to(m)
-    m.save(output_path)  # pyright: ignore [reportUnknownMemberType]
+def open_contacts(config: Config, meshcore: MeshCore):
+    return ContactStore.open(config.cache_path, meshcore.self_info["public_key"])
+
+
+async def load_contacts(config: Config, meshcore: MeshCore, *, refresh: bool = False):
+    """
+    The device's contacts from the cache, synced first if refreshing or stale.
+    """
+    contacts = open_contacts(config, meshcore)
+    if refresh or contacts.stale(config.contacts_max_age):
+        await contacts.sync(meshcore, refresh=refresh)
+    return contacts
+
+
+async def create_map(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    output_path: Path,
+    refresh: bool = False,
+    format: Optional[str] = None,
+    types: Optional[list[str]] = None,
+    max_age: Optional[float] = None,
+    cell_size: Optional[float] = None,
+):
+    contacts = (await load_contacts(config, meshcore, refresh=refresh)).contacts
+    positions = contact_positions(
+        contacts.values(),
+        types=frozenset(contact_type(e) for e in types) if types else None,
+        max_age=max_age,
+    )
+    count = write_map(positions, output_path, format=format, cluster_threshold=config.map_cluster_threshold, cell_size=cell_size)
+    logging.info(f"Mapped {len(contacts)} contacts at {count} positions to {output_path}")
+
+
+async def contacts_near(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    lat: float,
+    lon: float,
+    radius_km: Optional[float] = None,
+    count: Optional[int] = None,
+    types: Optional[list[str]] = None,
+    refresh: bool = False,
+):
+    """
+    Contacts within radius_km of lat, lon, or the count nearest, nearest first
+    with their distance_km.
+    """
+    if radius_km is None and count is None:
+        raise Exception("Need a radius or a count")
+    contacts = (await load_contacts(config, meshcore, refresh=refresh)).contacts
+    index = GridIndex.build(contacts, types=frozenset(contact_type(e) for e in types) if types else None)
+    if count is not None:
+        found = index.nearest(lat, lon, count, radius_km)
+    else:
+        assert radius_km is not None
+        found = index.within(lat, lon, radius_km)
+    return [{**contacts[index.keys[i]], "distance_km": round(distance, 3)} for distance, i in found]
+
+
+async def contacts_in_bbox(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    min_lat: float,
+    min_lon: float,
+    max_lat: float,
+    max_lon: float,
+    types: Optional[list[str]] = None,
+    refresh: bool = False,
+):
+    """
+    Contacts inside the box, which crosses the antimeridian if min_lon > max_lon.
+    """
+    contacts = (await load_contacts(config, meshcore, refresh=refresh)).contacts
+    index = GridIndex.build(contacts, types=frozenset(contact_type(e) for e in types) if types else None)
+    return [contacts[index.keys[i]] for i in index.in_bbox(min_lat, min_lon, max_lat, max_lon)]
 
 
 # this is silly, but connected has a future in it, so...
@@ -75,33 +178,79 @@ async def resolve_event(event: Event):
     return event
 
 
-async def subscribe(config: Config, meshcore: MeshCore, *, xfilter: Optional[str] = None):
-    event_q = asyncio.Queue[Event]()
+async def subscribe(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    event_filter: EventFilter = EventFilter(),
+    writer: Optional[NDJSONWriter] = None,
+    backfill: Optional[bytes] = None,
+):
+    """
+    Output matching events, pretty printed, or through writer as ndjson or
+    binary records, starting with those mcore-tcp-bridge kept from before
+    connecting if given a backfill request.
+    """
+    event_q = asyncio.Queue[Event](maxsize=config.subscribe_queue_size)
+    dropped = 0
 
     def callback(_event: Event):
-        event_q.put_nowait(_event)
-
-    subscription = meshcore.dispatcher.subscribe(None, callback)  # pyright: ignore [reportUnknownMemberType]
+        nonlocal dropped
+        try:
+            event_q.put_nowait(_event)
+        except asyncio.QueueFull:
+            dropped += 1
+
+    # NOTE only the filtered types, so the dispatcher drops everything else
+    event_types = event_filter.event_types if event_filter.event_types is not None else [None]
+    subscriptions = [meshcore.dispatcher.subscribe(event_type, callback) for event_type in event_types]  # pyright: ignore [reportUnknownMemberType]
     try:
+        if backfill is not None:
+            # NOTE the bridge answers with the kept pushes then OK, so they're queued by the time it returns
+            result = await meshcore.commands.send(backfill, [EventType.OK, EventType.ERROR])
+            if result.type == EventType.ERROR:
+                raise Exception(f"Unable to backfill, only mcore-tcp-bridge can: {result.payload}")
         while True:
             event = await event_q.get()
+            if dropped:
+                logging.warning(f"Dropped {dropped} events, output is falling behind")
+                dropped = 0
             if config.subscribe_resolve_event:
                 event = await resolve_event(event)
-            if xfilter:
-                env = {"event": event, "EventType": EventType}
-                valid = eval(xfilter, None, env)
-            else:
-                valid = True
-            if valid:
+            if not event_filter.matches(event):
+                continue
+            if writer is None:
                 jout(event)
+                continue
+            writer.write(event)
+            # NOTE flush once a burst has been written rather than per event
+            if event_q.empty():
+                writer.flush()
     finally:
-        subscription.unsubscribe()
-
-
-async def resolve_public_key(meshcore: MeshCore, *, public_key: Optional[str] = None, name: Optional[str] = None):
+        for subscription in subscriptions:
+            subscription.unsubscribe()
+        if writer is not None:
+            writer.close()
+
+
+async def resolve_public_key(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    public_key: Optional[str] = None,
+    name: Optional[str] = None,
+    refresh: bool = False,
+):
     if name is not None:
-        await meshcore.ensure_contacts()
-        contact = meshcore.get_contact_by_name(name)
+        contacts = open_contacts(config, meshcore)
+        synced = refresh or contacts.stale(config.contacts_max_age)
+        if synced:
+            await contacts.sync(meshcore, refresh=refresh)
+        contact = contacts.get_by_name(name)
+        if contact is None and not synced:
+            # NOTE the contact may have been added since the last sync
+            await contacts.sync(meshcore)
+            contact = contacts.get_by_name(name)
         if contact is None:
             raise Exception(f"Unknown contact: {name}")
         public_key = contact["public_key"]
@@ -112,178 +261,714 @@ async def resolve_public_key(meshcore: MeshCore, *, public_key: Optional[str] =
     raise Exception("Missing destination key")
 
 
-async def resolve_channel_idx(meshcore: MeshCore, *, channel_idx: Optional[int] = None, channel_name: Optional[str] = None):
+class ChannelTable:
+    """
+    A device's channel names by index, persisted under the cache directory
+    keyed by the device's public key. Secrets aren't kept.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.names = dict[int, str]()
+
+    @staticmethod
+    def open(cache_path: Path, device_public_key: str):
+        table = ChannelTable(cache_path / "channels" / f"{device_public_key}.json")
+        table.load()
+        return table
+
+    def load(self):
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return
+        self.names = {int(channel_idx): name for channel_idx, name in data["names"].items()}
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"names": self.names}))
+        os.replace(tmp_path, self.path)
+
+    def find(self, channel_name: str) -> Optional[int]:
+        for channel_idx, name in self.names.items():
+            if name == channel_name:
+                return channel_idx
+        return None
+
+    def set(self, channel_idx: int, channel_name: str):
+        if channel_name == "":
+            self.names.pop(channel_idx, None)
+        else:
+            self.names[channel_idx] = channel_name
+        self.save()
+
+    async def fetch(self, meshcore: MeshCore, *, window: int, timeout: float):
+        """
+        Every used channel slot, keeping up to window requests in flight
+        rather than waiting on each response, up to the device's last slot or
+        MAX_CHANNEL_IDX.
+        """
+        responses = asyncio.Queue[Event]()
+
+        def callback(_event: Event):
+            responses.put_nowait(_event)
+
+        subscriptions = [
+            meshcore.dispatcher.subscribe(event_type, callback)  # pyright: ignore [reportUnknownMemberType]
+            for event_type in (EventType.CHANNEL_INFO, EventType.ERROR)
+        ]
+        channels: list[Event] = []
+        try:
+            sent = 0
+            received = 0
+            done = False
+            while True:
+                while not done and sent < MAX_CHANNEL_IDX and sent - received < window:
+                    await meshcore.commands.send(bytes([CommandType.GET_CHANNEL.value, sent]))
+                    sent += 1
+                if received == sent:
+                    break
+                try:
+                    channel = await asyncio.wait_for(responses.get(), timeout)
+                except TimeoutError:
+                    raise Exception("Timed out getting channels")
+                received += 1
+                if channel.type == EventType.ERROR:
+                    # NOTE past the device's last channel slot
+                    done = True
+                elif channel.payload["channel_name"] != "":
+                    channels.append(channel)
+        finally:
+            for subscription in subscriptions:
+                subscription.unsubscribe()
+        channels.sort(key=lambda e: e.payload["channel_idx"])
+        self.names = {channel.payload["channel_idx"]: channel.payload["channel_name"] for channel in channels}
+        self.save()
+        return channels
+
+
+def open_channels(config: Config, meshcore: MeshCore):
+    return ChannelTable.open(config.cache_path, meshcore.self_info["public_key"])
+
+
+async def fetch_channels(config: Config, meshcore: MeshCore):
+    return await open_channels(config, meshcore).fetch(meshcore, window=config.channel_window, timeout=config.channel_timeout)
+
+
+async def resolve_channel_idx(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    channel_idx: Optional[int] = None,
+    channel_name: Optional[str] = None,
+    refresh: bool = False,
+):
     if channel_idx is not None:
         return channel_idx
     assert channel_name is not None
-    i = 0
-    while i <= MAX_CHANNEL_IDX:
-        channel = await meshcore.commands.get_channel(i)
-        test_channel_name = channel.payload["channel_name"]
-        if test_channel_name == "":
-            break
-        if test_channel_name == channel_name:
-            return channel.payload["channel_idx"]
-        i += 1
-    return None
-
-
-async def send_msg(meshcore: MeshCore, message: str, *, public_key: Optional[str] = None, name: Optional[str] = None):
-    public_key = await resolve_public_key(meshcore, public_key=public_key, name=name)
+    channels = open_channels(config, meshcore)
+    channel_idx = None if refresh else channels.find(channel_name)
+    if channel_idx is not None:
+        # NOTE check the cached slot, another client may have changed it
+        channel = await meshcore.commands.get_channel(channel_idx)
+        if channel.type != EventType.ERROR and channel.payload["channel_name"] == channel_name:
+            return channel_idx
+    await channels.fetch(meshcore, window=config.channel_window, timeout=config.channel_timeout)
+    return channels.find(channel_name)
+
+
+async def send_msg(
+    config: Config,
+    meshcore: MeshCore,
+    message: str,
+    *,
+    public_key: Optional[str] = None,
+    name: Optional[str] = None,
+    refresh: bool = False,
+):
+    public_key = await resolve_public_key(config, meshcore, public_key=public_key, name=name, refresh=refresh)
     return await meshcore.commands.send_msg(public_key, message)
 
 
-async def remove_contact(meshcore: MeshCore, *, public_key: Optional[str] = None, name: Optional[str] = None):
-    public_key = await resolve_public_key(meshcore, public_key=public_key, name=name)
-    return await meshcore.commands.remove_contact(public_key)
+def bulk_pipeline(config: Config, meshcore: MeshCore):
+    return bulk.Pipeline(meshcore, window=config.bulk_window, timeout=config.bulk_timeout)
+
+
+def airtime_limiter(config: Config, meshcore: MeshCore):
+    return bulk.AirtimeLimiter(meshcore.self_info, duty_cycle=config.airtime_duty_cycle, burst=config.airtime_burst)
+
+
+async def bulk_send_msg(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    message: Optional[str] = None,
+    input_path: Optional[Path] = None,
+    concurrency: int = 1,
+    refresh: bool = False,
+):
+    """
+    Send message to each recipient read from input_path, a contact name or
+    public key per line, or a json object of name or public_key and
+    message. Contacts are synced once up front, as nothing else may talk to
+    the device while the pipeline is running.
+    """
+    contacts = await load_contacts(config, meshcore, refresh=refresh)
+
+    def recipient(item: Any) -> tuple[str, Optional[str]]:
+        if isinstance(item, str):
+            return item, message
+        return item.get("public_key") or item.get("name"), item.get("message", message)
+
+    async def handle(item: Any):
+        destination, text = recipient(item)
+        if not destination:
+            raise Exception("Missing destination")
+        if text is None:
+            raise Exception("Missing message")
+        contact = contacts.get_by_name(destination)
+        if contact is not None:
+            public_key = contact["public_key"]
+        elif len(destination) >= 12 and all(c in "0123456789abcdefABCDEF" for c in destination):
+            public_key = destination
+        else:
+            raise Exception(f"Unknown contact: {destination}")
+        return await bulk.send_msg(pipeline, acks, limiter, public_key, text, attempts=config.msg_attempts)
+
+    pipeline = bulk_pipeline(config, meshcore)
+    acks = bulk.AckTracker(meshcore)
+    limiter = airtime_limiter(config, meshcore)
+    try:
+        return await run_lines(bulk.parse_item, handle, input_path=input_path, concurrency=concurrency)
+    finally:
+        pipeline.close()
+        acks.close()
+
+
+async def bulk_send_chan_msg(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    channel_idx: Optional[int] = None,
+    channel_name: Optional[str] = None,
+    input_path: Optional[Path] = None,
+    concurrency: int = 1,
+    refresh: bool = False,
+):
+    """
+    Send each message read from input_path, a line of text to the given
+    channel, or a json object of message and channel_idx or channel_name.
+    Channel names in the input must be in the cached channel table.
+    """
+    if channel_idx is not None or channel_name is not None:
+        channel_idx = await resolve_channel_idx(config, meshcore, channel_idx=channel_idx, channel_name=channel_name, refresh=refresh)
+        if channel_idx is None:
+            raise Exception(f"Channel not found")
+    channels = open_channels(config, meshcore)
+    sender = meshcore.self_info.get("name", "")
+
+    async def handle(item: Any):
+        _channel_idx, text = channel_idx, item
+        if not isinstance(item, str):
+            text = item.get("message")
+            if item.get("channel_idx") is not None:
+                _channel_idx = item["channel_idx"]
+            elif item.get("channel_name") is not None:
+                _channel_idx = channels.find(item["channel_name"])
+                if _channel_idx is None:
+                    raise Exception(f"Unknown channel: {item['channel_name']}")
+        if _channel_idx is None:
+            raise Exception("Missing channel")
+        if text is None:
+            raise Exception("Missing message")
+        return await bulk.send_chan_msg(pipeline, limiter, _channel_idx, text, sender=sender)
+
+    pipeline = bulk_pipeline(config, meshcore)
+    limiter = airtime_limiter(config, meshcore)
+    try:
+        return await run_lines(bulk.parse_item, handle, input_path=input_path, concurrency=concurrency)
+    finally:
+        pipeline.close()
+
+
+async def bulk_import_contact(config: Config, meshcore: MeshCore, *, input_path: Optional[Path] = None, concurrency: int = 1):
+    """
+    Import each meshcore:// uri read from input_path, one per line or as a
+    json object's uri.
+    """
 
+    async def handle(item: Any):
+        return await bulk.import_contact(pipeline, item if isinstance(item, str) else item.get("uri", ""))
 
-async def amain():
-    logging.basicConfig(level=logging.INFO)
-    parser = argparse.ArgumentParser()
+    pipeline = bulk_pipeline(config, meshcore)
+    try:
+        return await run_lines(bulk.parse_item, handle, input_path=input_path, concurrency=concurrency)
+    finally:
+        pipeline.close()
+
+
+async def remove_contact(
+    config: Config,
+    meshcore: MeshCore,
+    *,
+    public_key: Optional[str] = None,
+    name: Optional[str] = None,
+    refresh: bool = False,
+):
+    public_key = await resolve_public_key(config, meshcore, public_key=public_key, name=name, refresh=refresh)
+    result = await meshcore.commands.remove_contact(public_key)
+    if result.type != EventType.ERROR:
+        open_contacts(config, meshcore).remove(public_key)
+    return result
+
+
+class CommandParser(argparse.ArgumentParser):
+    """
+    Raises on bad arguments or -h rather than printing and exiting, so one
+    bad line doesn't end a batch or write into its output.
+    """
+
+    def error(self, message: str):  # pyright: ignore [reportIncompatibleMethodOverride]
+        raise Exception(message)
+
+    def exit(self, status: int = 0, message: Optional[str] = None):  # pyright: ignore [reportIncompatibleMethodOverride]
+        raise Exception(message or f"Exited with status {status}")
+
+    def print_help(self, file: Any = None):
+        raise Exception(self.format_help())
+
+
+GetMeshCore = Callable[[], Awaitable[MeshCore]]
+Argument = tuple[tuple[Any, ...], dict[str, Any]]
+
+
+@dataclasses.dataclass(frozen=True)
+class Subcommand:
+    """
+    A mcore-cli command, its arguments and the coroutine running it. Heavy
+    dependencies are imported where run needs them rather than at module
+    load, so only the commands using them pay for loading them.
+    """
+
+    name: str
+    help: Optional[str]
+    arguments: tuple[Argument, ...]
+    run: Callable[[Config, argparse.Namespace, GetMeshCore], Awaitable[Any]]
+
+
+# in the order they're listed in --help
+SUBCOMMANDS = dict[str, Subcommand]()
+
+
+def argument(*args: Any, **kwargs: Any) -> Argument:
+    return args, kwargs
+
+
+def subcommand(name: str, *arguments: Argument, help: Optional[str] = None):
+    def register(run: Callable[[Config, argparse.Namespace, GetMeshCore], Awaitable[Any]]):
+        SUBCOMMANDS[name] = Subcommand(name, help, arguments, run)
+        return run
+
+    return register
+
+
+def build_parser(parser_class: type[argparse.ArgumentParser] = argparse.ArgumentParser):
+    parser = parser_class()
     parser.add_argument("-c", metavar="config_path", type=Path, default=default_config_path)
     parser.add_argument("-d", action="store_true", help="enable debug")
+    parser.add_argument("--refresh", action="store_true", help="Refresh cached contacts from the device")
     subparsers = parser.add_subparsers(dest="command")
-    subparser = subparsers.add_parser("create-map", help="Create an html map of device contact locations")
-    subparser.add_argument("-o", metavar="output_path", type=Path, help="Output file path", required=True)
-    subparser = subparsers.add_parser("subscribe", help="Subscribe to device events")
-    subparser.add_argument("--xfilter")
-    subparser = subparsers.add_parser("remove-contact", help="Remove a contact from the device")
-    subparser.add_argument("-n", metavar="name")
-    subparser.add_argument("--public-key")
-    subparsers.add_parser("self-info", help="Show information about the device")
-    subparsers.add_parser("reboot")
-    subparsers.add_parser("get-contacts", help="Get device contacts")
-    subparser = subparsers.add_parser("send-msg", help="Send a message")
-    subparser.add_argument("-n", metavar="name")
-    subparser.add_argument("--public-key")
-    subparser.add_argument("-m", metavar="message", required=True)
-    subparsers.add_parser("get-msg", help="Get a message")
-    subparser = subparsers.add_parser("get-channel", help="Get channel info")
-    subparser.add_argument("--channel-name", metavar="channel_name", type=str)
-    subparser.add_argument("--channel-idx", metavar="channel_index", type=int)
-    subparser = subparsers.add_parser("send-chan-msg", help="Send a channel message")
-    subparser.add_argument("--channel-name", metavar="channel_name", type=str)
-    subparser.add_argument("--channel-idx", metavar="channel_index", type=int)
-    subparser.add_argument("-m", metavar="message", required=True)
-    subparser = subparsers.add_parser("set-channel", help="Set channel")
-    subparser.add_argument("--channel-idx", metavar="channel_index", type=int, required=True)
-    subparser.add_argument("--channel-name", metavar="channel_name", type=str, required=True)
-    subparser = subparsers.add_parser("remove-channel", help="Remove channel")
-    subparser.add_argument("--channel-name", metavar="channel_name", type=str)
-    subparser.add_argument("--channel-idx", metavar="channel_index", type=int)
-    subparsers.add_parser("get-channels", help="Get channels")
-    subparser = subparsers.add_parser("export-contact", help="Export contact information")
-    subparser.add_argument("-n", metavar="name")
-    subparser.add_argument("--public-key")
-    subparser = subparsers.add_parser("import-contact", help="Import contact information")
-    subparser.add_argument("--uri", required=True)
-    subparser = subparsers.add_parser("send-advert", help="Send advertisement")
-    subparser.add_argument("--flood", action="store_true")
-    args = parser.parse_args()
+    for command in SUBCOMMANDS.values():
+        subparser = subparsers.add_parser(command.name, help=command.help)
+        for args, kwargs in command.arguments:
+            subparser.add_argument(*args, **kwargs)
+    return parser
+
+
+def parse_batch_line(line: str) -> tuple[Any, list[str]]:
+    """
+    (id, arguments) for a batch line, which is a json array of arguments, a
+    json object with args and an optional id to echo back, or shell quoted
+    arguments.
+    """
+    if line.startswith("["):
+        return None, json.loads(line)
+    if line.startswith("{"):
+        data = json.loads(line)
+        return data.get("id"), data["args"]
+    return None, shlex.split(line)
+
+
+async def batch(
+    config: Config,
+    get_meshcore: Callable[[], Awaitable[MeshCore]],
+    *,
+    input_path: Optional[Path] = None,
+    concurrency: int = 1,
+):
+    """
+    Run each line's command and write one ndjson result per line, in
+    completion order, with up to concurrency lines read and parsed ahead.
+    Returns the number of commands that failed.
+    """
+    parser = build_parser(CommandParser)
+    # NOTE meshcore matches responses by type alone, so two commands in flight could swap them
+    command_lock = asyncio.Lock()
+
+    async def handle(argv: list[str]):
+        args = parser.parse_args(argv)
+        if args.command is None:
+            raise Exception("Missing command")
+        if args.command in UNBATCHABLE_COMMANDS:
+            raise Exception(f"Can't batch {args.command}")
+        async with command_lock:
+            return {"result": await run_command(config, args, get_meshcore)}
+
+    return await run_lines(parse_batch_line, handle, input_path=input_path, concurrency=concurrency)
+
+
+TYPE_ARGUMENT = argument("-t", "--type", action="append", help="Only contacts of this type, chat, repeater, room, sensor or a number, repeatable")
+CHANNEL_ARGUMENTS = (
+    argument("--channel-name", metavar="channel_name", type=str),
+    argument("--channel-idx", metavar="channel_index", type=int),
+)
+CONTACT_ARGUMENTS = (
+    argument("-n", metavar="name"),
+    argument("--public-key"),
+)
+
+
+@subcommand(
+    "create-map",
+    argument("-o", metavar="output_path", type=Path, help="Output file path", required=True),
+    argument("--format", choices=MAP_FORMATS, help="Output format, by default from the output path's suffix"),
+    TYPE_ARGUMENT,
+    argument("--max-age", metavar="seconds", type=float, help="Only contacts advertised in the last seconds"),
+    argument("--grid", metavar="degrees", type=float, help="Aggregate contacts into cells of this many degrees"),
+    help="Create an html map of device contact locations",
+)
+async def run_create_map(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    await create_map(
+        config,
+        meshcore,
+        output_path=args.o,
+        refresh=args.refresh,
+        format=args.format,
+        types=args.type,
+        max_age=args.max_age,
+        cell_size=args.grid,
+    )
+
+
+@subcommand(
+    "subscribe",
+    argument("--xfilter", help="Python expression of event"),
+    argument("-t", "--event-type", action="append", help="Only events of this type, repeatable"),
+    argument("-w", "--where", action="append", help="Payload predicate, field=value, field!=value, field~regex or field>number"),
+    argument("--ndjson", action="store_true", help="Output one compact json event per line"),
+    argument("--binary", action="store_true", help="Output length prefixed binary records rather than ndjson, read back with read_records"),
+    argument("-o", metavar="output_path", type=Path, help="Write ndjson, or binary records, to output_path.<time> files instead of stdout"),
+    argument("--rotate-size", metavar="bytes", type=int, help="Start a new output file after this many bytes"),
+    argument("--rotate-interval", metavar="seconds", type=float, help="Start a new output file after this many seconds"),
+    argument("--compress", action="store_true", help="gzip output files"),
+    argument("--backfill", metavar="count", type=int, help="Start with up to count events mcore-tcp-bridge kept from before connecting"),
+    argument("--backfill-seconds", metavar="seconds", type=int, help="Start with the events mcore-tcp-bridge kept from the last seconds"),
+    help="Subscribe to device events",
+)
+async def run_subscribe(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    event_filter = EventFilter.compile(event_types=args.event_type, where=args.where, xfilter=args.xfilter)
+    writer: Optional[NDJSONWriter] = None
+    writer_class = RecordWriter if args.binary else NDJSONWriter
+    if args.o is not None:
+        sink = RotatingFileSink(args.o, max_bytes=args.rotate_size, interval=args.rotate_interval, compress=args.compress)
+        writer = writer_class(sink)
+    elif args.ndjson or args.binary:
+        writer = writer_class(StdoutSink())
+    backfill = None
+    if args.backfill is not None or args.backfill_seconds is not None:
+        backfill = backfill_request(count=args.backfill, seconds=args.backfill_seconds)
+    await subscribe(config, meshcore, event_filter=event_filter, writer=writer, backfill=backfill)
+
+
+@subcommand("remove-contact", *CONTACT_ARGUMENTS, help="Remove a contact from the device")
+async def run_remove_contact(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await remove_contact(config, meshcore, public_key=args.public_key, name=args.n, refresh=args.refresh)
+
+
+@subcommand("self-info", help="Show information about the device")
+async def run_self_info(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return meshcore.self_info
+
+
+@subcommand("reboot", help="Reboot the device")
+async def run_reboot(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await meshcore.commands.reboot()
+
+
+@subcommand("get-contacts", help="Get device contacts")
+async def run_get_contacts(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await meshcore.commands.get_contacts()
+
+
+@subcommand(
+    "contacts-near",
+    argument("--lat", type=float, required=True),
+    argument("--lon", type=float, required=True),
+    argument("-r", metavar="radius_km", type=float, help="Only contacts within this many km"),
+    argument("-k", metavar="count", type=int, help="Only the count nearest contacts"),
+    TYPE_ARGUMENT,
+    help="Contacts within a radius of, or nearest to, a point",
+)
+async def run_contacts_near(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await contacts_near(config, meshcore, lat=args.lat, lon=args.lon, radius_km=args.r, count=args.k, types=args.type, refresh=args.refresh)
+
+
+@subcommand(
+    "contacts-in-bbox",
+    argument("--min-lat", type=float, required=True),
+    argument("--min-lon", type=float, required=True),
+    argument("--max-lat", type=float, required=True),
+    argument("--max-lon", type=float, required=True),
+    TYPE_ARGUMENT,
+    help="Contacts inside a bounding box",
+)
+async def run_contacts_in_bbox(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await contacts_in_bbox(
+        config,
+        meshcore,
+        min_lat=args.min_lat,
+        min_lon=args.min_lon,
+        max_lat=args.max_lat,
+        max_lon=args.max_lon,
+        types=args.type,
+        refresh=args.refresh,
+    )
+
+
+@subcommand("send-msg", *CONTACT_ARGUMENTS, argument("-m", metavar="message", required=True), help="Send a message")
+async def run_send_msg(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await send_msg(config, meshcore, message=args.m, public_key=args.public_key, name=args.n, refresh=args.refresh)
+
+
+@subcommand("get-msg", help="Get a message")
+async def run_get_msg(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await meshcore.commands.get_msg()
+
+
+@subcommand("get-channel", *CHANNEL_ARGUMENTS, help="Get channel info")
+async def run_get_channel(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    channel_idx = await resolve_channel_idx(config, meshcore, channel_name=args.channel_name, channel_idx=args.channel_idx, refresh=args.refresh)
+    if channel_idx is None:
+        raise Exception(f"Channel not found")
+    return await meshcore.commands.get_channel(channel_idx)
+
+
+@subcommand("send-chan-msg", *CHANNEL_ARGUMENTS, argument("-m", metavar="message", required=True), help="Send a channel message")
+async def run_send_chan_msg(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    channel_idx = await resolve_channel_idx(config, meshcore, channel_name=args.channel_name, channel_idx=args.channel_idx, refresh=args.refresh)
+    if channel_idx is None:
+        raise Exception(f"Channel not found")
+    return await meshcore.commands.send_chan_msg(channel_idx, args.m)  # pyright: ignore [reportUnknownMemberType]
+
+
+@subcommand(
+    "set-channel",
+    argument("--channel-idx", metavar="channel_index", type=int, required=True),
+    argument("--channel-name", metavar="channel_name", type=str, required=True),
+    help="Set channel",
+)
+async def run_set_channel(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    result = await meshcore.commands.set_channel(args.channel_idx, args.channel_name)
+    if result.type != EventType.ERROR:
+        open_channels(config, meshcore).set(args.channel_idx, args.channel_name)
+    return result
+
+
+@subcommand("remove-channel", *CHANNEL_ARGUMENTS, help="Remove channel")
+async def run_remove_channel(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    channel_idx = await resolve_channel_idx(config, meshcore, channel_name=args.channel_name, channel_idx=args.channel_idx, refresh=args.refresh)
+    if channel_idx is None:
+        raise Exception(f"Channel not found")
+    result = await meshcore.commands.set_channel(channel_idx, "", bytes.fromhex(16 * "00"))
+    if result.type != EventType.ERROR:
+        open_channels(config, meshcore).set(channel_idx, "")
+
+
+@subcommand("get-channels", help="Get channels")
+async def run_get_channels(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await fetch_channels(config, meshcore)
+
+
+@subcommand("export-contact", *CONTACT_ARGUMENTS, help="Export contact information")
+async def run_export_contact(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    if args.public_key or args.n:
+        public_key = await resolve_public_key(config, meshcore, public_key=args.public_key, name=args.n, refresh=args.refresh)
+    else:
+        public_key = None
+    return await meshcore.commands.export_contact(key=public_key)
+
+
+@subcommand("import-contact", argument("--uri", required=True), help="Import contact information")
+async def run_import_contact(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    uri = args.uri
+    meshcore_uri_prefix = "meshcore://"
+    if uri.startswith(meshcore_uri_prefix):
+        card_data = bytes.fromhex(uri[len(meshcore_uri_prefix) :])
+        return await meshcore.commands.import_contact(card_data)  # pyright: ignore [reportUnknownMemberType]
+    else:
+        raise Exception()
+
+
+@subcommand("send-advert", argument("--flood", action="store_true"), help="Send advertisement")
+async def run_send_advert(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    return await meshcore.commands.send_advert(flood=args.flood)
+
+
+BULK_ARGUMENTS = (
+    argument("-i", metavar="input_path", type=Path, help="Input file path, stdin by default"),
+    argument("-j", metavar="concurrency", type=int, default=16, help="Items in progress at once"),
+)
+
+
+@subcommand(
+    "bulk-send-msg",
+    *BULK_ARGUMENTS,
+    argument("-m", metavar="message", help="Message for recipients given without one"),
+    help="Send a message to each contact read one per line, retrying until acked",
+)
+async def run_bulk_send_msg(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    failed = await bulk_send_msg(config, meshcore, message=args.m, input_path=args.i, concurrency=args.j, refresh=args.refresh)
+    if failed:
+        sys.exit(1)
+
+
+@subcommand(
+    "bulk-send-chan-msg",
+    *BULK_ARGUMENTS,
+    *CHANNEL_ARGUMENTS,
+    help="Send each channel message read one per line",
+)
+async def run_bulk_send_chan_msg(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    failed = await bulk_send_chan_msg(
+        config,
+        meshcore,
+        channel_idx=args.channel_idx,
+        channel_name=args.channel_name,
+        input_path=args.i,
+        concurrency=args.j,
+        refresh=args.refresh,
+    )
+    if failed:
+        sys.exit(1)
+
+
+@subcommand("bulk-import-contact", *BULK_ARGUMENTS, help="Import each contact uri read one per line")
+async def run_bulk_import_contact(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    meshcore = await get_meshcore()
+    failed = await bulk_import_contact(config, meshcore, input_path=args.i, concurrency=args.j)
+    if failed:
+        sys.exit(1)
+
+
+@subcommand(
+    "batch",
+    argument("-i", metavar="input_path", type=Path, help="Input file path, stdin by default"),
+    argument("-j", metavar="concurrency", type=int, default=1, help="Lines read and parsed ahead, commands still run one at a time"),
+    help="Run commands read one per line over one connection",
+)
+async def run_batch(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore):
+    failed = await batch(config, get_meshcore, input_path=args.i, concurrency=args.j)
+    if failed:
+        sys.exit(1)
+
+
+async def run_command(config: Config, args: argparse.Namespace, get_meshcore: GetMeshCore) -> Any:
+    """
+    Run one parsed command, returning its result for output.
+    """
+    command = SUBCOMMANDS.get(args.command)
+    if command is None:
+        raise Exception(f"Unknown command: {args.command}")
+    return await command.run(config, args, get_meshcore)
+
 
+def load_config(config_path: Path, *, debug: bool = False):
     config_data: dict[str, Any]
     try:
-        config_data = yaml.safe_load(args.c.read_text())
+        config_data = yaml.safe_load(config_path.read_text())
     except FileNotFoundError:
         config_data = {}
-    if args.d:
+    if debug:
         config_data["loglevel"] = "DEBUG"
-    config = Config.from_data(config_data)
+    return Config.from_data(config_data)
+
+
+async def create_meshcore(config: Config) -> MeshCore:
+    meshcore: Optional[MeshCore]
+    if config.driver == MeshCoreDriver.TCP:
+        meshcore = await MeshCore.create_tcp(  # pyright: ignore [reportUnknownMemberType]
+            config.mc_endpoint[0], config.mc_endpoint[1], auto_reconnect=True, max_reconnect_attempts=999
+        )
+    elif config.driver == MeshCoreDriver.SERIAL:
+        meshcore = await MeshCore.create_serial(str(config.serial_device_path))  # pyright: ignore [reportUnknownMemberType]
+    else:
+        raise Exception(f"Unknown driver {config.driver}")
+    # NOTE typed as always returning a MeshCore, but None when the connection fails
+    if meshcore is None:  # pyright: ignore [reportUnnecessaryComparison]
+        raise Exception("Unable to connect to device")
+    return meshcore
+
+
+async def amain():
+    logging.basicConfig(level=logging.INFO)
+    parser = build_parser()
+    args = parser.parse_args()
+
+    config = load_config(args.c, debug=args.d)
     logging.root.setLevel(config.loglevel)
     logging.debug(config)
 
     main_task = asyncio.current_task(asyncio.get_event_loop())
     assert main_task is not None
 
+    meshcore: Optional[MeshCore] = None
+    meshcore_lock = asyncio.Lock()
+
     async def get_meshcore():
-        if config.driver == MeshCoreDriver.TCP:
-            return await MeshCore.create_tcp(  # pyright: ignore [reportUnknownMemberType]
-                config.mc_endpoint[0], config.mc_endpoint[1], auto_reconnect=True, max_reconnect_attempts=999
-            )
-        elif config.driver == MeshCoreDriver.SERIAL:
-            return await MeshCore.create_serial(str(config.serial_device_path))  # pyright: ignore [reportUnknownMemberType]
-        else:
-            raise Exception(f"Unknown driver {config.driver}")
+        # NOTE one connection per process, shared by every command in a batch
+        nonlocal meshcore
+        async with meshcore_lock:
+            if meshcore is None:
+                meshcore = await create_meshcore(config)
+            return meshcore
 
     if args.command is None:
         parser.print_help()
-    elif args.command == "create-map":
-        meshcore = await get_meshcore()
-        await create_map(meshcore, output_path=args.o)
-    elif args.command == "subscribe":
-        meshcore = await get_meshcore()
-        await subscribe(config, meshcore, xfilter=args.xfilter)
-    elif args.command == "remove-contact":
-        meshcore = await get_meshcore()
-        jout(await remove_contact(meshcore, public_key=args.public_key, name=args.n))
-    elif args.command == "self-info":
-        meshcore = await get_meshcore()
-        jout(meshcore.self_info)
-    elif args.command == "reboot":
-        meshcore = await get_meshcore()
-        jout(await meshcore.commands.reboot())
-    elif args.command == "get-contacts":
-        meshcore = await get_meshcore()
-        jout(await meshcore.commands.get_contacts())
-    elif args.command == "send-msg":
-        meshcore = await get_meshcore()
-        jout(await send_msg(meshcore, message=args.m, public_key=args.public_key, name=args.n))
-    elif args.command == "get-msg":
-        meshcore = await get_meshcore()
-        jout(await meshcore.commands.get_msg())
-    elif args.command == "send-chan-msg":
-        meshcore = await get_meshcore()
-        channel_idx = await resolve_channel_idx(meshcore, channel_name=args.channel_name, channel_idx=args.channel_idx)
-        if channel_idx is None:
-            raise Exception(f"Channel not found")
-        jout(await meshcore.commands.send_chan_msg(channel_idx, args.m))  # pyright: ignore [reportUnknownMemberType]
-    elif args.command == "set-channel":
-        meshcore = await get_meshcore()
-        jout(await meshcore.commands.set_channel(args.channel_idx, args.channel_name))
-    elif args.command == "get-channel":
-        meshcore = await get_meshcore()
-        channel_idx = await resolve_channel_idx(meshcore, channel_name=args.channel_name, channel_idx=args.channel_idx)
-        if channel_idx is None:
-            raise Exception(f"Channel not found")
-        jout(await meshcore.commands.get_channel(channel_idx))
-    elif args.command == "get-channels":
-        meshcore = await get_meshcore()
-        channels: list[Event] = []
-        for i in range(MAX_CHANNEL_IDX):
-            channel = await meshcore.commands.get_channel(i)
-            if channel.payload["channel_name"] != "":
-                channels.append(channel)
-        jout(channels)
-    elif args.command == "remove-channel":
-        meshcore = await get_meshcore()
-        channel_idx = await resolve_channel_idx(meshcore, channel_name=args.channel_name, channel_idx=args.channel_idx)
-        if channel_idx is None:
-            raise Exception(f"Channel not found")
-        await meshcore.commands.set_channel(channel_idx, "", bytes.fromhex(16 * "00"))
-    elif args.command == "export-contact":
-        meshcore = await get_meshcore()
-        if args.public_key or args.n:
-            public_key = await resolve_public_key(meshcore, public_key=args.public_key, name=args.n)
-        else:
-            public_key = None
-        contact = await meshcore.commands.export_contact(key=public_key)
-        jout(contact)
-    elif args.command == "import-contact":
-        meshcore = await get_meshcore()
-        uri = args.uri
-        meshcore_uri_prefix = "meshcore://"
-        if uri.startswith(meshcore_uri_prefix):
-            card_data = bytes.fromhex(uri[len(meshcore_uri_prefix) :])
-            result = await meshcore.commands.import_contact(card_data)  # pyright: ignore [reportUnknownMemberType]
-            jout(result)
-        else:
-            raise Exception()
-    elif args.command == "send-advert":
-        meshcore = await get_meshcore()
-        jout(await meshcore.commands.send_advert(flood=args.flood))
     else:
-        raise Exception(f"Unknown command: {args.command}")
+        result = await run_command(config, args, get_meshcore)
+        if result is not None:
+            jout(result)
 
 
 def main():
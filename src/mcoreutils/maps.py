@@ -0,0 +1,160 @@
+import csv
+import dataclasses
+import json
+import math
+import time
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from mcoreutils.geo import located
+
+# positions this close, in degrees, are one position, about a meter apart
+POSITION_PRECISION = 5
+MAP_FORMATS = ("html", "geojson", "csv")
+# NOTE rows are [lat, lon, popup], bound in the browser rather than one python object per marker
+CLUSTER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {radius: 4});
+    marker.bindPopup(row[2]);
+    return marker;
+}
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class Position:
+    lat: float
+    lon: float
+    names: tuple[str, ...]
+
+    @property
+    def label(self):
+        return ", ".join(self.names)
+
+
+def contact_positions(
+    contacts: Iterable[dict[str, Any]],
+    *,
+    types: Optional[frozenset[int]] = None,
+    max_age: Optional[float] = None,
+):
+    """
+    One position per distinct location, naming every contact there, skipping
+    contacts without a position, not of types, or not heard from in max_age
+    seconds.
+    """
+    oldest = None if max_age is None else time.time() - max_age
+    names = dict[tuple[float, float], list[str]]()
+    for contact in contacts:
+        if types is not None and contact.get("type") not in types:
+            continue
+        if oldest is not None and contact.get("last_advert", 0) < oldest:
+            continue
+        position = located(contact)
+        if position is None:
+            continue
+        key = (round(position[0], POSITION_PRECISION), round(position[1], POSITION_PRECISION))
+        names.setdefault(key, []).append(contact.get("adv_name", ""))
+    return [Position(lat, lon, tuple(sorted(_names))) for (lat, lon), _names in names.items()]
+
+
+def grid_positions(positions: list[Position], cell_size: float):
+    """
+    positions aggregated into cells of cell_size degrees, each at its
+    members' mean position.
+    """
+    cells = dict[tuple[int, int], list[Position]]()
+    for position in positions:
+        cells.setdefault((math.floor(position.lat / cell_size), math.floor(position.lon / cell_size)), []).append(position)
+    return [
+        Position(
+            sum(p.lat for p in members) / len(members),
+            sum(p.lon for p in members) / len(members),
+            tuple(name for p in members for name in p.names),
+        )
+        for members in cells.values()
+    ]
+
+
+def write_html(positions: list[Position], output_path: Path, *, cluster_threshold: int, aggregated: bool = False):
+    # NOTE folium pulls in jinja2 and branca, too slow to load for every mcore-cli run
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    m = folium.Map(zoom_start=4)
+    if aggregated:
+        for position in positions:
+            folium.CircleMarker(
+                [position.lat, position.lon],
+                popup=f"{len(position.names)} contacts",
+                tooltip=str(len(position.names)),
+                radius=4 + 2 * math.log2(len(position.names)),
+            ).add_to(m)
+    elif len(positions) > cluster_threshold:
+        FastMarkerCluster([[p.lat, p.lon, p.label] for p in positions], callback=CLUSTER_CALLBACK).add_to(m)
+    else:
+        for position in positions:
+            folium.CircleMarker([position.lat, position.lon], popup=position.label, radius=4).add_to(m)
+    if positions:
+        bounds = [[min(p.lat for p in positions), min(p.lon for p in positions)], [max(p.lat for p in positions), max(p.lon for p in positions)]]
+        m.fit_bounds(bounds)  # pyright: ignore [reportUnknownMemberType]
+    m.save(output_path)  # pyright: ignore [reportUnknownMemberType]
+
+
+def write_geojson(positions: list[Position], output_path: Path):
+    features = [
+        {
+            "type": "Feature",
+            # NOTE geojson coordinates are lon, lat
+            "geometry": {"type": "Point", "coordinates": [p.lon, p.lat]},
+            "properties": {"names": p.names, "count": len(p.names)},
+        }
+        for p in positions
+    ]
+    output_path.write_text(json.dumps({"type": "FeatureCollection", "features": features}, separators=(",", ":")))
+
+
+def write_csv(positions: list[Position], output_path: Path):
+    with output_path.open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["lat", "lon", "count", "names"])
+        for p in positions:
+            writer.writerow([p.lat, p.lon, len(p.names), ";".join(p.names)])
+
+
+def map_format(output_path: Path, format: Optional[str] = None):
+    if format is not None:
+        return format
+    suffix = output_path.suffix.lower()
+    if suffix in (".geojson", ".json"):
+        return "geojson"
+    if suffix == ".csv":
+        return "csv"
+    return "html"
+
+
+def write_map(
+    positions: list[Position],
+    output_path: Path,
+    *,
+    format: Optional[str] = None,
+    cluster_threshold: int = 1000,
+    cell_size: Optional[float] = None,
+):
+    """
+    Write positions as html, clustered past cluster_threshold, geojson or
+    csv, by format or else output_path's suffix, aggregated into cells of
+    cell_size degrees if given.
+    """
+    if cell_size is not None:
+        positions = grid_positions(positions, cell_size)
+    format = map_format(output_path, format)
+    if format == "html":
+        write_html(positions, output_path, cluster_threshold=cluster_threshold, aggregated=cell_size is not None)
+    elif format == "geojson":
+        write_geojson(positions, output_path)
+    elif format == "csv":
+        write_csv(positions, output_path)
+    else:
+        raise Exception(f"Unknown map format: {format}")
+    return len(positions)
@@ -0,0 +1,236 @@
+import asyncio
+import bisect
+import logging
+from abc import ABC, abstractmethod
+from asyncio import StreamReader, StreamWriter
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+T = TypeVar("T")
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = ""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class GaugeValue:
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class HistogramValue:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # NOTE last slot counts observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """
+        Upper bound of the bucket holding the q quantile, inf past the last bucket.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metric(ABC, Generic[T]):
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: tuple[str, ...] = (), registry: Optional["Registry"] = None):
+        self.name = name
+        self.doc = doc
+        self.labelnames = labelnames
+        self.children = dict[tuple[str, ...], T]()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    @abstractmethod
+    def create(self) -> T: ...
+
+    def labels(self, *values: str) -> T:
+        child = self.children.get(values)
+        if child is None:
+            child = self.create()
+            self.children[values] = child
+        return child
+
+    def remove(self, *values: str):
+        self.children.pop(values, None)
+
+    @abstractmethod
+    def render(self) -> list[str]: ...
+
+    @abstractmethod
+    def summarize(self) -> list[str]: ...
+
+
+class Counter(Metric[CounterValue]):
+    kind = "counter"
+
+    def create(self):
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def render(self):
+        return [f"{self.name}{format_labels(self.labelnames, values)} {child.value}" for values, child in self.children.items()]
+
+    def summarize(self):
+        return [f"{self.name}{format_labels(self.labelnames, values)}={child.value:g}" for values, child in self.children.items()]
+
+
+class Gauge(Metric[GaugeValue]):
+    kind = "gauge"
+
+    def create(self):
+        return GaugeValue()
+
+    def track(self, fn: Callable[[], float], *values: str):
+        """
+        Sample fn when rendering instead of setting the gauge as things change.
+        """
+        self.children[values] = GaugeValue(fn)
+
+    def render(self):
+        return [f"{self.name}{format_labels(self.labelnames, values)} {child.get()}" for values, child in self.children.items()]
+
+    def summarize(self):
+        return [f"{self.name}{format_labels(self.labelnames, values)}={child.get():g}" for values, child in self.children.items()]
+
+
+class Histogram(Metric[HistogramValue]):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        doc: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Optional["Registry"] = None,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = buckets
+        super().__init__(name, doc, labelnames, registry)
+
+    def create(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self):
+        lines: list[str] = []
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = format_labels(self.labelnames, values, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, values)} {child.sum}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, values)} {child.count}")
+        return lines
+
+    def summarize(self):
+        return [
+            f"{self.name}{format_labels(self.labelnames, values)}=n:{child.count} p50<={child.quantile(0.5):g} p99<={child.quantile(0.99):g}"
+            for values, child in self.children.items()
+            if child.count
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = list[Metric[Any]]()
+
+    def register(self, metric: Metric[Any]):
+        self.metrics.append(metric)
+
+    def render(self):
+        """
+        Prometheus text exposition format.
+        """
+        lines: list[str] = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        return " ".join(line for metric in self.metrics for line in metric.summarize())
+
+
+REGISTRY = Registry()
+
+
+async def serve_metrics(host: str, port: int, registry: Registry = REGISTRY):
+    async def handler(reader: StreamReader, writer: StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # NOTE headers are read and ignored
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] in ("/", "/metrics"):
+                status = "200 OK"
+                body = registry.render().encode()
+            else:
+                status = "404 Not Found"
+                body = b"not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            logging.error(f"metrics: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handler, host=host, port=port)
+    await server.serve_forever()
+
+
+async def log_metrics(interval: float, registry: Registry = REGISTRY):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"metrics: {registry.summary()}")
@@ -0,0 +1,133 @@
+import gzip
+import sys
+import time
+from io import BufferedWriter
+from pathlib import Path
+from typing import Any, Optional, Protocol
+
+from mcoreutils.common import bdump, jdump
+
+
+class Sink(Protocol):
+    def write(self, data: bytes) -> Any: ...
+
+    def flush(self) -> Any: ...
+
+    def close(self) -> Any: ...
+
+
+class StdoutSink:
+    def __init__(self):
+        self.stream = sys.stdout.buffer
+
+    def write(self, data: bytes):
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+
+class RotatingFileSink:
+    """
+    Writes to path.<start time>, moving on to a new file once max_bytes have
+    been written, uncompressed, or interval seconds have passed. Compressed
+    files are gzip streams that are only flushed when rotated or closed, as
+    flushing a compressor throws away its history.
+    """
+
+    def __init__(self, path: Path, *, max_bytes: Optional[int] = None, interval: Optional[float] = None, compress: bool = False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.compress = compress
+        self.file: Optional[gzip.GzipFile | BufferedWriter] = None
+        self.opened_at = 0.0
+        self.written = 0
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        suffix = ".gz" if self.compress else ""
+        path = self.path.with_name(f"{self.path.name}.{stamp}{suffix}")
+        i = 1
+        while path.exists():
+            path = self.path.with_name(f"{self.path.name}.{stamp}-{i}{suffix}")
+            i += 1
+        self.file = gzip.open(path, "wb") if self.compress else path.open("wb")
+        self.opened_at = time.monotonic()
+        self.written = 0
+
+    def rotating(self):
+        if self.max_bytes is not None and self.written >= self.max_bytes:
+            return True
+        return self.interval is not None and time.monotonic() - self.opened_at >= self.interval
+
+    def write(self, data: bytes):
+        if self.file is not None and self.rotating():
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            self.open()
+        assert self.file is not None
+        self.file.write(data)
+        self.written += len(data)
+
+    def flush(self):
+        if self.file is not None and not self.compress:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class NDJSONWriter:
+    """
+    One jdump line per object, so output reads back with jload, gathered
+    into writes of about buffer_size. Flushing is left to the caller, who
+    knows when a burst is over.
+    """
+
+    def __init__(self, sink: Sink, buffer_size: int = 64 * 1024):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.pending = list[bytes]()
+        self.pending_bytes = 0
+
+    def encode(self, o: Any):
+        return (jdump(o) + "\n").encode()
+
+    def write(self, o: Any):
+        data = self.encode(o)
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.buffer_size:
+            self.drain()
+
+    def drain(self):
+        if self.pending:
+            self.sink.write(b"".join(self.pending))
+            self.pending.clear()
+            self.pending_bytes = 0
+
+    def flush(self):
+        self.drain()
+        self.sink.flush()
+
+    def close(self):
+        self.drain()
+        self.sink.close()
+
+
+class RecordWriter(NDJSONWriter):
+    """
+    One bdump record per object instead of a line, read back with
+    read_records.
+    """
+
+    def encode(self, o: Any):
+        return bdump(o)
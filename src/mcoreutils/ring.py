@@ -0,0 +1,81 @@
+import bisect
+import time
+from array import array
+from typing import Optional
+
+
+class FrameRing:
+    """
+    The most recent frames, up to capacity bytes and max_frames of them,
+    copied into one preallocated buffer rather than kept as an object each,
+    with a ring of (time, offset, length) indexing them. Frames are numbered
+    as they arrive, so a client can ask for exactly those from before it
+    connected.
+    """
+
+    def __init__(self, capacity: int, max_frames: int):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.max_frames = max_frames
+        self.times = array("d", [0.0]) * max_frames
+        self.offsets = array("I", [0]) * max_frames
+        self.lengths = array("I", [0]) * max_frames
+        # index slot of the oldest frame
+        self.first = 0
+        self.count = 0
+        # buffer offset just past the newest frame
+        self.end = 0
+        # frames ever kept, the next frame's number
+        self.appended = 0
+
+    def __len__(self):
+        return self.count
+
+    def slot(self, i: int):
+        return (self.first + i) % self.max_frames
+
+    def overlaps(self, slot: int, pos: int, size: int):
+        # NOTE frames before pos are all newer, they end at or before it
+        return pos <= self.offsets[slot] < pos + size
+
+    def evict(self):
+        self.first = (self.first + 1) % self.max_frames
+        self.count -= 1
+
+    def append(self, frame: bytes | bytearray, now: Optional[float] = None):
+        size = len(frame)
+        if size > len(self.buffer) or self.max_frames == 0:
+            return
+        pos = self.end
+        if pos + size > len(self.buffer):
+            # NOTE frames are never split, the space left at the end goes unused this time round
+            while self.count and self.offsets[self.first] >= pos:
+                self.evict()
+            pos = 0
+        # NOTE the oldest frames are the ones just past the end, so evicting from the front frees the space in order
+        while self.count and (self.count == self.max_frames or self.overlaps(self.first, pos, size)):
+            self.evict()
+        self.view[pos : pos + size] = frame
+        slot = self.slot(self.count)
+        self.times[slot] = time.monotonic() if now is None else now
+        self.offsets[slot] = pos
+        self.lengths[slot] = size
+        self.count += 1
+        self.end = pos + size
+        self.appended += 1
+
+    def select(self, *, before: Optional[int] = None, count: Optional[int] = None, since: Optional[float] = None):
+        """
+        Copies of the frames numbered below before, the last count of them
+        and those kept since a time.monotonic() time, oldest first.
+        """
+        end = self.count if before is None else min(self.count, max(before - (self.appended - self.count), 0))
+        start = 0 if count is None else max(end - count, 0)
+        if since is not None:
+            start = bisect.bisect_left(range(start, end), since, key=lambda i: self.times[self.slot(i)]) + start
+        frames = list[bytes]()
+        for i in range(start, end):
+            slot = self.slot(i)
+            offset = self.offsets[slot]
+            frames.append(bytes(self.view[offset : offset + self.lengths[slot]]))
+        return frames
@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import logging
+import struct
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+from meshcore.packets import CommandType, PacketType
+
+from mcoreutils.capture import FROM_DEVICE, TO_DEVICE, read_capture
+from mcoreutils.framing import is_final_response, is_push
+
+OK = bytes([PacketType.OK.value])
+EMPTY_CONTACTS = [
+    bytes([PacketType.CONTACT_START.value]) + (0).to_bytes(4, byteorder="little"),
+    bytes([PacketType.CONTACT_END.value]) + (0).to_bytes(4, byteorder="little"),
+]
+SIMULATOR_NAME = b"simulator"
+# ms a sender should wait for an ack, as the device suggests in MSG_SENT
+SUGGESTED_TIMEOUT = 2000
+
+
+def expected_ack(data: bytes):
+    # NOTE differs per attempt, as the attempt number is part of the request
+    return (zlib.crc32(data) & 0xFFFFFFFF).to_bytes(4, byteorder="little")
+
+
+def self_info():
+    frame = bytearray(58)
+    frame[0] = PacketType.SELF_INFO.value
+    # NOTE zeroed radio settings and location, a fixed public key
+    frame[4:36] = bytes(range(32))
+    return bytes(frame) + SIMULATOR_NAME
+
+
+def default_responses(data: bytes):
+    """
+    Minimal well formed answers for the commands meshcore clients expect
+    something other than OK from.
+    """
+    command = data[0]
+    if command == CommandType.APP_START.value:
+        return [self_info()]
+    elif command == CommandType.GET_CONTACTS.value:
+        return EMPTY_CONTACTS
+    elif command == CommandType.SYNC_NEXT_MESSAGE.value:
+        return [bytes([PacketType.NO_MORE_MSGS.value])]
+    elif command == CommandType.GET_DEVICE_TIME.value:
+        return [bytes([PacketType.CURRENT_TIME.value]) + int(time.time()).to_bytes(4, byteorder="little")]
+    elif command == CommandType.SEND_TXT_MSG.value:
+        # NOTE sent direct, type 0, rather than flooded
+        return [bytes([PacketType.MSG_SENT.value, 0]) + expected_ack(data) + SUGGESTED_TIMEOUT.to_bytes(4, byteorder="little")]
+    elif command == CommandType.GET_CHANNEL.value and len(data) > 1:
+        # NOTE every channel is empty
+        return [bytes([PacketType.CHANNEL_INFO.value, data[1]]) + bytes(48)]
+    return [OK]
+
+
+# wall clock time a synthetic push was generated, after its code
+SYNTHETIC_TIME = struct.Struct("<d")
+
+
+def load_responses(path: Path):
+    """
+    Request frame -> the responses the device gave it, from a capture.
+    """
+    responses = dict[bytes, list[bytes]]()
+    pending = collections.deque[tuple[bytes, list[bytes]]]()
+    for _, direction, frame in read_capture(path):
+        if direction == TO_DEVICE:
+            pending.append((frame, []))
+        elif direction == FROM_DEVICE and not is_push(frame) and pending:
+            request, frames = pending[0]
+            frames.append(frame)
+            if is_final_response(request[0], frame):
+                pending.popleft()
+                responses[request] = frames
+    return responses
+
+
+class SimulatedConnection:
+    """
+    Stands in for meshcore's SerialConnection without a radio. Commands are
+    answered with the responses recorded for the same request in replay_path,
+    otherwise a minimal default. Pushes are replayed from the capture at speed
+    times their recorded rate, as fast as possible when speed is 0, and/or
+    generated at synthetic_rate per second. Synthetic pushes carry the time
+    they were generated, so a load test can measure their latency. Direct
+    messages are acked ack_delay seconds after they're sent, or never if
+    ack_delay is None.
+    """
+
+    def __init__(
+        self,
+        *,
+        replay_path: Optional[Path] = None,
+        speed: float = 1.0,
+        loop: bool = False,
+        synthetic_rate: float = 0.0,
+        synthetic_size: int = 33,
+        latency: float = 0.0,
+        ack_delay: Optional[float] = None,
+    ):
+        self.replay_path = replay_path
+        self.speed = speed
+        self.loop = loop
+        self.synthetic_rate = synthetic_rate
+        self.synthetic_size = synthetic_size
+        self.latency = latency
+        self.ack_delay = ack_delay
+        self.reader: Any = None
+        self.disconnect_callback: Optional[Callable[[str], Awaitable[None]]] = None
+        self.responses = dict[bytes, list[bytes]]()
+        self.requests = asyncio.Queue[tuple[float, bytes]]()
+        self.tasks = list[asyncio.Task[None]]()
+        self.acks = set[asyncio.Task[None]]()
+
+    def set_reader(self, reader: Any):
+        self.reader = reader
+
+    def set_disconnect_callback(self, callback: Callable[[str], Awaitable[None]]):
+        self.disconnect_callback = callback
+
+    async def connect(self):
+        if self.replay_path is not None:
+            self.responses = load_responses(self.replay_path)
+            logging.info(f"simulator: {len(self.responses)} recorded responses from {self.replay_path}")
+        self.tasks.append(asyncio.create_task(self.respond()))
+        if self.replay_path is not None:
+            self.tasks.append(asyncio.create_task(self.replay(self.replay_path)))
+        if self.synthetic_rate > 0:
+            self.tasks.append(asyncio.create_task(self.synthesize()))
+
+    async def disconnect(self):
+        for task in [*self.tasks, *self.acks]:
+            task.cancel()
+        self.tasks.clear()
+
+    async def send(self, data: bytes):
+        self.requests.put_nowait((time.monotonic() + self.latency, data))
+
+    def respond_to(self, data: bytes):
+        responses = self.responses.get(data)
+        if responses is not None:
+            return responses
+        return default_responses(data)
+
+    async def respond(self):
+        # NOTE one task so responses keep the order of their requests
+        while True:
+            due, data = await self.requests.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            for frame in self.respond_to(data):
+                await self.reader.handle_rx(frame)
+                if frame[0] == PacketType.MSG_SENT.value and self.ack_delay is not None:
+                    task = asyncio.create_task(self.ack(frame[2:6]))
+                    self.acks.add(task)
+                    task.add_done_callback(self.acks.discard)
+
+    async def ack(self, code: bytes):
+        await asyncio.sleep(self.ack_delay or 0)
+        trip_time = int((self.ack_delay or 0) * 1000)
+        await self.reader.handle_rx(bytes([PacketType.ACK.value]) + code + trip_time.to_bytes(4, byteorder="little"))
+
+    async def replay(self, path: Path):
+        while True:
+            start: Optional[float] = None
+            started = time.monotonic()
+            for timestamp, direction, frame in read_capture(path):
+                if direction != FROM_DEVICE or not is_push(frame):
+                    continue
+                if start is None:
+                    start = timestamp
+                if self.speed > 0:
+                    delay = started + (timestamp - start) / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                else:
+                    # NOTE still yield so clients get a look in
+                    await asyncio.sleep(0)
+                await self.reader.handle_rx(frame)
+            if not self.loop:
+                logging.info(f"simulator: replay of {path} finished")
+                return
+
+    async def synthesize(self):
+        started = time.monotonic()
+        sent = 0
+        while True:
+            due = int((time.monotonic() - started) * self.synthetic_rate) + 1
+            for _ in range(due - sent):
+                frame = bytearray(max(self.synthetic_size, 1 + SYNTHETIC_TIME.size))
+                frame[0] = PacketType.ADVERTISEMENT.value
+                SYNTHETIC_TIME.pack_into(frame, 1, time.time())
+                await self.reader.handle_rx(bytes(frame))
+            sent = due
+            await asyncio.sleep(max(1 / self.synthetic_rate, 0.001))
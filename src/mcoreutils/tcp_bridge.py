@@ -1,112 +1,860 @@
 import argparse
 import asyncio
+import collections
 import dataclasses
+import enum
+import itertools
 import logging
 import signal
+import struct
+import time
 from asyncio import AbstractEventLoop, StreamReader, StreamWriter, TaskGroup, CancelledError
 from pathlib import Path
-from typing import Any
+from typing import Any, Optional
 
 import platformdirs
 import yaml
 from meshcore import SerialConnection
+from meshcore.packets import CommandType, PacketType
+
+from mcoreutils.capture import FROM_DEVICE, TO_DEVICE, CaptureWriter
+from mcoreutils.common import TokenBucket
+from mcoreutils.framing import (
+    BACKFILL,
+    BACKFILL_COUNT,
+    BACKFILL_REQUEST,
+    BACKFILL_SECONDS,
+    HEADER_SZ,
+    encode_frame,
+    is_final_response,
+    is_push,
+    read_frame,
+)
+from mcoreutils.metrics import Counter, Gauge, Histogram, log_metrics, serve_metrics
+from mcoreutils.ring import FrameRing
+from mcoreutils.simulator import SimulatedConnection
 
 default_config_path = platformdirs.user_config_path("mcoreutils.tcp_server.yaml")
 default_host = "localhost"
 default_port = 1234
 SIGNATURE = b"\x01\x03      mccli"
+# serial frames are 8N1, so 10 bits on the wire per byte
+SERIAL_BITS_PER_BYTE = 10
+# the device's error codes, for commands the bridge answers itself
+ERR_CODE_UNSUPPORTED_CMD = 1
+ERR_CODE_ILLEGAL_ARG = 6
+
+
+def command_codes(*names: str):
+    # NOTE tolerate commands missing from older meshcore releases
+    return frozenset(CommandType[name].value for name in names if name in CommandType.__members__)
+
+
+# commands that make the radio transmit
+TX_COMMANDS = command_codes(
+    "SEND_TXT_MSG",
+    "SEND_CHANNEL_TXT_MSG",
+    "SEND_SELF_ADVERT",
+    "SEND_RAW_DATA",
+    "SEND_LOGIN",
+    "SEND_STATUS_REQ",
+    "SEND_TRACE_PATH",
+    "SEND_TELEMETRY_REQ",
+    "BINARY_REQ",
+    "PATH_DISCOVERY",
+    "SEND_CONTROL_DATA",
+    "SEND_ANON_REQ",
+    "SEND_CHANNEL_DATA",
+    "SEND_RAW_PACKET",
+)
+# commands that move a lot of data or airtime, scheduled behind everything else
+BULK_COMMANDS = command_codes(
+    "GET_CONTACTS",
+    "ADD_UPDATE_CONTACT",
+    "EXPORT_CONTACT",
+    "IMPORT_CONTACT",
+    "SHARE_CONTACT",
+    "SEND_SELF_ADVERT",
+    "SEND_RAW_DATA",
+    "SEND_TRACE_PATH",
+)
+INTERACTIVE = 0
+BULK = 1
+# seconds a read only query's response may be served from the cache
+DEFAULT_CACHE_TTLS = {
+    "APP_START": 60.0,
+    "DEVICE_QEURY": 3600.0,
+    "GET_CHANNEL": 300.0,
+    "GET_CONTACTS": 60.0,
+    "GET_CONTACT_BY_KEY": 60.0,
+}
+CONTACT_QUERIES = command_codes("GET_CONTACTS", "GET_CONTACT_BY_KEY")
+SELF_QUERIES = command_codes("APP_START", "DEVICE_QEURY")
+# cached queries made stale by a command
+CACHE_INVALIDATIONS = {
+    **{code: command_codes("GET_CHANNEL") for code in command_codes("SET_CHANNEL")},
+    **{code: CONTACT_QUERIES for code in command_codes("ADD_UPDATE_CONTACT", "REMOVE_CONTACT", "IMPORT_CONTACT", "RESET_PATH")},
+    **{
+        code: SELF_QUERIES
+        for code in command_codes(
+            "SET_ADVERT_NAME",
+            "SET_ADVERT_LATLON",
+            "SET_RADIO_PARAMS",
+            "SET_RADIO_TX_POWER",
+            "SET_TUNING_PARAMS",
+            "SET_OTHER_PARAMS",
+            "IMPORT_PRIVATE_KEY",
+        )
+    },
+}
+# commands after which nothing cached can be trusted
+CACHE_CLEARS = command_codes("REBOOT", "FACTORY_RESET")
+# pushes that mean the device's contact table changed
+CONTACT_PUSH_CODES = frozenset(
+    PacketType[name].value for name in ("ADVERTISEMENT", "PATH_UPDATE", "PUSH_CODE_NEW_ADVERT", "CONTACT_DELETED") if name in PacketType.__members__
+)
+
+device_frames = Counter("mcore_bridge_device_frames_total", "Frames received from the device", ("device", "kind"))
+device_bytes = Counter("mcore_bridge_device_bytes_total", "Payload bytes received from the device", ("device",))
+frame_queue_depth = Gauge("mcore_bridge_frame_queue_depth", "Device frames waiting to be routed", ("device",))
+route_seconds = Histogram("mcore_bridge_route_seconds", "Time to route a device frame to client queues", ("device",))
+response_seconds = Histogram("mcore_bridge_response_seconds", "Time from writing a command to its first response", ("device", "command"))
+clients_connected = Gauge("mcore_bridge_clients", "Connected clients", ("device",))
+client_frames = Counter("mcore_bridge_client_frames_total", "Frames received from clients", ("device",))
+client_bytes = Counter("mcore_bridge_client_bytes_total", "Payload bytes received from clients", ("device",))
+client_sent_bytes = Counter("mcore_bridge_client_sent_bytes_total", "Bytes written to a client", ("device", "client"))
+client_dropped_frames = Counter("mcore_bridge_client_dropped_frames_total", "Frames dropped for a slow client", ("device", "client"))
+client_queue_bytes = Gauge("mcore_bridge_client_queue_bytes", "Bytes queued for a client", ("device", "client"))
+client_drain_seconds = Histogram("mcore_bridge_client_drain_seconds", "Time a client writer waits on drain", ("device",))
+request_seconds = Histogram("mcore_bridge_request_seconds", "Time the client handler spends handing off a command", ("device",))
+cache_requests = Counter("mcore_bridge_cache_requests_total", "Response cache lookups", ("device", "result"))
+scheduler_queue_depth = Gauge("mcore_bridge_scheduler_queue_depth", "Client commands waiting for the serial link", ("device",))
+serial_frames = Counter("mcore_bridge_serial_frames_total", "Frames written to the device", ("device",))
+serial_bytes = Counter("mcore_bridge_serial_bytes_total", "Payload bytes written to the device", ("device",))
+serial_send_seconds = Histogram("mcore_bridge_serial_send_seconds", "Time spent in connection.send", ("device",))
+backfill_kept_frames = Gauge("mcore_bridge_backfill_kept_frames", "Pushes kept for backfill", ("device",))
+backfill_sent_frames = Counter("mcore_bridge_backfill_sent_frames_total", "Pushes sent to clients as backfill", ("device",))
+
+
+def command_name(code: int):
+    try:
+        return CommandType(code).name
+    except ValueError:
+        return str(code)
+
+
+class DeviceDriver(enum.Enum):
+    SERIAL = "serial"
+    SIMULATOR = "simulator"
 
 
 @dataclasses.dataclass(frozen=True)
-class Config:
-    serial_device_path: Path
+class DeviceConfig:
+    serial_device_path: Optional[Path] = None
     host: str = default_host
     port: int = default_port
+    # also listen on a unix socket here
+    unix_path: Optional[Path] = None
     baudrate: int = 115200
-    loglevel: int = logging.INFO
-    check_signature: bool = True
+    # used in logs and metrics, defaults to serial_device_path
+    name: Optional[str] = None
+    driver: DeviceDriver = DeviceDriver.SERIAL
+    # append every frame to and from the device here
+    capture_path: Optional[Path] = None
+    # simulator only, see SimulatedConnection
+    replay_path: Optional[Path] = None
+    replay_speed: float = 1.0
+    replay_loop: bool = False
+    synthetic_rate: float = 0.0
+    synthetic_size: int = 33
+    simulated_latency: float = 0.0
+    simulated_ack_delay: Optional[float] = None
+
+    @property
+    def label(self):
+        if self.name is not None:
+            return self.name
+        if self.serial_device_path is not None:
+            return str(self.serial_device_path)
+        return f"{self.driver.value}:{self.port}"
 
     @staticmethod
     def from_data(data: dict[str, Any]):
         kwargs = data.copy()
         if "serial_device_path" in data:
             kwargs["serial_device_path"] = Path(data["serial_device_path"])
+        if "driver" in data:
+            kwargs["driver"] = DeviceDriver(data["driver"])
+        if "unix_path" in data:
+            kwargs["unix_path"] = Path(data["unix_path"])
+        if "capture_path" in data:
+            kwargs["capture_path"] = Path(data["capture_path"])
+        if "replay_path" in data:
+            kwargs["replay_path"] = Path(data["replay_path"])
+        return DeviceConfig(**kwargs)
+
+    def create_connection(self):
+        if self.driver == DeviceDriver.SERIAL:
+            if self.serial_device_path is None:
+                raise Exception("Missing serial_device_path")
+            return SerialConnection(str(self.serial_device_path), baudrate=self.baudrate)
+        elif self.driver == DeviceDriver.SIMULATOR:
+            return SimulatedConnection(
+                replay_path=self.replay_path,
+                speed=self.replay_speed,
+                loop=self.replay_loop,
+                synthetic_rate=self.synthetic_rate,
+                synthetic_size=self.synthetic_size,
+                latency=self.simulated_latency,
+                ack_delay=self.simulated_ack_delay,
+            )
+        else:
+            raise Exception(f"Unknown driver {self.driver}")
+
+
+class SlowClientPolicy(enum.Enum):
+    DROP_OLDEST = "drop_oldest"
+    DISCONNECT = "disconnect"
+    PAUSE = "pause"
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    devices: tuple[DeviceConfig, ...] = ()
+    loglevel: int = logging.INFO
+    check_signature: bool = True
+    client_high_watermark: int = 64 * 1024
+    client_low_watermark: int = 16 * 1024
+    slow_client_policy: SlowClientPolicy = SlowClientPolicy.DROP_OLDEST
+    route_responses: bool = True
+    response_timeout: float = 15.0
+    scheduler_queue_size: int = 16
+    scheduler_quantum: int = 512
+    prioritize_interactive: bool = True
+    serial_burst: int = 1024
+    tx_rate: Optional[float] = None
+    tx_burst: int = 1
+    cache: bool = False
+    cache_size: int = 256
+    # command name -> seconds, 0 disables caching a command, see DEFAULT_CACHE_TTLS
+    cache_ttls: dict[str, float] = dataclasses.field(default_factory=dict[str, float])
+    # recent pushes kept per device for clients asking for backfill, 0 disables
+    backfill_bytes: int = 256 * 1024
+    backfill_frames: int = 4096
+    metrics_host: str = default_host
+    metrics_port: Optional[int] = None
+    metrics_log_interval: Optional[float] = None
+    # seconds before retrying a failed device, None leaves it down
+    reconnect_delay: Optional[float] = None
+
+    @staticmethod
+    def from_data(data: dict[str, Any]):
+        kwargs = data.copy()
+        # NOTE a single device may still be configured at the top level
+        device_keys = [field.name for field in dataclasses.fields(DeviceConfig) if field.name in data]
+        device_data = {key: kwargs.pop(key) for key in device_keys}
+        if "devices" in data:
+            kwargs["devices"] = tuple(DeviceConfig.from_data(e) for e in data["devices"])
+        elif device_data:
+            kwargs["devices"] = (DeviceConfig.from_data(device_data),)
         if "loglevel" in data:
             kwargs["loglevel"] = logging.getLevelName(data["loglevel"])  # pyright: ignore [reportDeprecated]
         if "listen" in data:
             kwargs["listen"] = tuple(data["listen"])
-        if "serial_device_path" in data:
-            kwargs["serial_device_path"] = Path(kwargs["serial_device_path"])
+        if "slow_client_policy" in data:
+            kwargs["slow_client_policy"] = SlowClientPolicy(data["slow_client_policy"])
         return Config(**kwargs)
 
 
-async def read_frame(reader: StreamReader):
-    byte0 = await reader.read(1)
-    if not byte0:
-        return None
-    data_sz_bytes = await reader.read(2)
-    if not data_sz_bytes:
-        return None
-    data_sz = int.from_bytes(data_sz_bytes, byteorder="little")
-    data = await reader.read(data_sz)
-    if not data:
-        return None
-    return data
+class Client:
+    """
+    Per client bounded frame queue, drained by its own writer task so a stalled
+    client only ever backs up its own queue.
+    """
+
+    def __init__(self, config: Config, device: str, addr: str, writer: StreamWriter):
+        self.config = config
+        self.device = device
+        self.addr = addr
+        self.writer = writer
+        self.frames = collections.deque[bytes | bytearray]()
+        self.queued = 0
+        self.label = str(addr)
+        self.sent = client_sent_bytes.labels(device, self.label)
+        self.dropped = client_dropped_frames.labels(device, self.label)
+        self.drain_seconds = client_drain_seconds.labels(device)
+        client_queue_bytes.track(lambda: self.queued, device, self.label)
+        self.pending = asyncio.Event()
+        # NOTE cleared while paused by the PAUSE policy
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, data: bytes | bytearray):
+        if not self.resumed.is_set():
+            self.dropped.inc()
+            return
+        self.frames.append(data)
+        self.queued += len(data)
+        self.pending.set()
+        if self.queued > self.config.client_high_watermark:
+            self.overflow()
+
+    def overflow(self):
+        policy = self.config.slow_client_policy
+        logging.warning(f"{self.addr}: slow client, {self.queued} bytes queued, applying {policy.value}")
+        if policy == SlowClientPolicy.DROP_OLDEST:
+            while self.frames and self.queued > self.config.client_low_watermark:
+                self.queued -= len(self.frames.popleft())
+                self.dropped.inc()
+        elif policy == SlowClientPolicy.DISCONNECT:
+            self.dropped.inc(len(self.frames))
+            self.frames.clear()
+            self.queued = 0
+            # NOTE abort rather than close, close would wait on the stalled buffer
+            self.writer.transport.abort()
+        elif policy == SlowClientPolicy.PAUSE:
+            self.resumed.clear()
+        else:
+            raise Exception(f"Unknown policy: {policy}")
+
+    async def run(self):
+        try:
+            while True:
+                await self.pending.wait()
+                self.pending.clear()
+                frames = list(self.frames)
+                self.frames.clear()
+                self.sent.inc(self.queued)
+                self.queued = 0
+                self.writer.writelines(frames)
+                start = time.perf_counter()
+                await self.writer.drain()
+                self.drain_seconds.observe(time.perf_counter() - start)
+                if not self.resumed.is_set() and self.queued <= self.config.client_low_watermark:
+                    logging.info(f"{self.addr}: resumed, dropped {self.dropped.value:g} frames")
+                    self.resumed.set()
+        except Exception as e:
+            # NOTE let the client handler remove it
+            logging.error(f"{self.addr}: {e}")
+            self.writer.transport.abort()
 
+    def close(self):
+        self.task.cancel()
+        for metric in (client_sent_bytes, client_dropped_frames, client_queue_bytes):
+            metric.remove(self.device, self.label)
 
-class Fanout:
-    def __init__(self):
-        self.writers = dict[str, asyncio.StreamWriter]()
 
-    def write(self, data: bytes):
-        for addr, writer in self.writers.items():
-            try:
-                writer.write(data)
-            except Exception as e:
-                # NOTE let the client handler remove it
-                logging.error(f"{addr}: {e}")
+class Fanout:
+    def __init__(self, config: Config, device: str):
+        self.config = config
+        self.device = device
+        self.clients = dict[str, Client]()
+        clients_connected.track(lambda: len(self.clients), device)
+
+    def write(self, data: bytes | bytearray):
+        for client in self.clients.values():
+            client.put(data)
+
+    def write_to(self, addr: str, data: bytes | bytearray):
+        client = self.clients.get(addr)
+        # NOTE the client may have gone away with commands outstanding
+        if client is not None:
+            client.put(data)
 
     def add(self, addr: str, writer: asyncio.StreamWriter):
-        self.writers[addr] = writer
+        client = Client(self.config, self.device, addr, writer)
+        self.clients[addr] = client
+        return client
 
     def remove(self, addr: str):
-        self.writers.pop(addr)
+        self.clients.pop(addr).close()
+
+
+@dataclasses.dataclass
+class CacheEntry:
+    expires: float
+    responses: list[bytes]
+
+
+class ResponseCache:
+    """
+    LRU cache of responses to read only queries, keyed on the request frame.
+    """
+
+    def __init__(self, config: Config, device: str):
+        self.config = config
+        self.device = device
+        self.entries = collections.OrderedDict[bytes, CacheEntry]()
+        ttls = DEFAULT_CACHE_TTLS | {name.upper(): ttl for name, ttl in config.cache_ttls.items()}
+        self.ttls = {CommandType[name].value: ttl for name, ttl in ttls.items() if name in CommandType.__members__ and ttl > 0}
+
+    def get(self, request: bytes):
+        entry = self.entries.get(request)
+        if entry is None:
+            cache_requests.labels(self.device, "miss").inc()
+            return None
+        if entry.expires < time.monotonic():
+            del self.entries[request]
+            cache_requests.labels(self.device, "expired").inc()
+            return None
+        self.entries.move_to_end(request)
+        cache_requests.labels(self.device, "hit").inc()
+        return entry.responses
+
+    def put(self, request: bytes, responses: list[bytes]):
+        ttl = self.ttls.get(request[0])
+        if ttl is None:
+            return
+        self.entries[request] = CacheEntry(time.monotonic() + ttl, responses)
+        self.entries.move_to_end(request)
+        while len(self.entries) > self.config.cache_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, commands: frozenset[int]):
+        for request in [request for request in self.entries if request[0] in commands]:
+            del self.entries[request]
+
+    def written(self, command: int):
+        if command in CACHE_CLEARS:
+            self.entries.clear()
+        elif command in CACHE_INVALIDATIONS:
+            self.invalidate(CACHE_INVALIDATIONS[command])
+
+
+@dataclasses.dataclass
+class Request:
+    addr: str
+    frame: bytes
+    sent_at: float
+    last_seen: float
+    answered: bool = False
+    responses: list[bytes] = dataclasses.field(default_factory=list[bytes])
+
+    @property
+    def command(self):
+        return self.frame[0]
+
+
+class Router:
+    """
+    Sends device responses only to the client whose command they answer. The
+    device handles commands in order, so outstanding commands are a fifo.
+    Pushes, and anything arriving with nothing outstanding, go to every client.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        device: str,
+        fanout: Fanout,
+        cache: Optional[ResponseCache] = None,
+        ring: Optional[FrameRing] = None,
+    ):
+        self.config = config
+        self.device = device
+        self.fanout = fanout
+        self.cache = cache
+        self.ring = ring
+        self.pending = collections.deque[Request]()
+        # clients waiting on progress with their commands
+        self.waiters = dict[str, asyncio.Event]()
+
+    def sent(self, addr: str, frame: bytes):
+        if self.config.route_responses:
+            now = time.monotonic()
+            self.pending.append(Request(addr, frame, now, now))
+        if self.cache is not None:
+            self.cache.written(frame[0])
+        self.wake(addr)
+
+    def outstanding(self, addr: str):
+        return any(request.addr == addr for request in self.pending)
+
+    def cached(self, addr: str, frame: bytes):
+        """
+        Cached responses for the client's request, only while it has nothing
+        outstanding so responses can't arrive out of order.
+        """
+        if self.cache is None or self.outstanding(addr):
+            return None
+        return self.cache.get(frame)
+
+    async def progress(self, addr: str):
+        """
+        Wait for one of the client's commands to be written, answered or
+        given up on.
+        """
+        await self.waiters.setdefault(addr, asyncio.Event()).wait()
+
+    def wake(self, addr: str):
+        event = self.waiters.pop(addr, None)
+        if event is not None:
+            event.set()
+
+    def complete(self, request: Request):
+        if self.cache is None:
+            return
+        # NOTE again on completion, a query that raced the write may have cached stale data
+        self.cache.written(request.command)
+        if request.responses[-1][0] != PacketType.ERROR.value:
+            self.cache.put(request.frame, request.responses)
+
+    def expire(self, now: float):
+        while self.pending and now - self.pending[0].last_seen > self.config.response_timeout:
+            request = self.pending.popleft()
+            logging.warning(f"{self.device}: {request.addr}: no response to command {request.command}")
+            self.wake(request.addr)
+
+    def route(self, frame: bytes):
+        data = encode_frame(frame)
+        if not is_push(frame):
+            now = time.monotonic()
+            self.expire(now)
+            if self.pending:
+                request = self.pending[0]
+                if not request.answered:
+                    response_seconds.labels(self.device, command_name(request.command)).observe(now - request.sent_at)
+                    request.answered = True
+                request.last_seen = now
+                if self.cache is not None:
+                    request.responses.append(frame)
+                self.fanout.write_to(request.addr, data)
+                if is_final_response(request.command, frame):
+                    self.pending.popleft()
+                    self.complete(request)
+                    self.wake(request.addr)
+                    # NOTE the next command only starts waiting once this one is done
+                    if self.pending:
+                        self.pending[0].last_seen = now
+                return
+        if self.cache is not None and frame and frame[0] in CONTACT_PUSH_CODES:
+            self.cache.invalidate(CONTACT_QUERIES)
+        if self.ring is not None and is_push(frame):
+            self.ring.append(data)
+        # NOTE encoded once and queued as one piece for every client
+        self.fanout.write(data)
+
+
+@dataclasses.dataclass
+class ClientCommands:
+    queue: collections.deque[bytes]
+    deficit: int
+    space: asyncio.Event
+
+    def __len__(self):
+        return len(self.queue)
+
+
+class WriteScheduler:
+    """
+    Deficit round robin over per client command queues in front of the serial
+    connection, with clients whose next command is interactive going ahead of
+    those whose next is bulk. A client's own commands always go in the order
+    it sent them, meshcore couldn't match the responses otherwise. Writes are paced
+    to the serial line rate, and commands that transmit over the radio can be
+    paced to tx_rate, so no single client can monopolize the device.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        device: DeviceConfig,
+        connection: SerialConnection | SimulatedConnection,
+        router: Router,
+        capture: Optional[CaptureWriter] = None,
+    ):
+        self.config = config
+        self.device = device
+        self.connection = connection
+        self.router = router
+        self.capture = capture
+        self.clients = dict[str, ClientCommands]()
+        self.active = (collections.deque[str](), collections.deque[str]())
+        self.ready = asyncio.Event()
+        self.serial = TokenBucket(device.baudrate / SERIAL_BITS_PER_BYTE, config.serial_burst)
+        self.tx = TokenBucket(config.tx_rate, config.tx_burst) if config.tx_rate else None
+        scheduler_queue_depth.track(lambda: sum(len(commands) for commands in self.clients.values()), device.label)
+        self.send_seconds = serial_send_seconds.labels(device.label)
+        self.frames = serial_frames.labels(device.label)
+        self.bytes = serial_bytes.labels(device.label)
+
+    def classify(self, frame: bytes):
+        if self.config.prioritize_interactive and frame[0] in BULK_COMMANDS:
+            return BULK
+        return INTERACTIVE
+
+    async def submit(self, addr: str, frame: bytes):
+        commands = self.clients.get(addr)
+        if commands is None:
+            commands = ClientCommands(collections.deque(), 0, asyncio.Event())
+            self.clients[addr] = commands
+        # NOTE backpressure, the client handler stops reading until there is space
+        while len(commands) >= self.config.scheduler_queue_size:
+            commands.space.clear()
+            await commands.space.wait()
+        if not commands.queue:
+            self.active[self.classify(frame)].append(addr)
+            commands.deficit = self.config.scheduler_quantum
+        commands.queue.append(frame)
+        self.ready.set()
+
+    def queued(self, addr: str):
+        commands = self.clients.get(addr)
+        return 0 if commands is None else len(commands)
 
+    def remove(self, addr: str):
+        commands = self.clients.pop(addr, None)
+        if commands is None:
+            return
+        if commands.queue:
+            self.active[self.classify(commands.queue[0])].remove(addr)
+
+    def pick(self) -> tuple[Optional[tuple[str, bytes]], Optional[float]]:
+        """
+        Next (addr, frame) to send, otherwise how long until a radio transmit
+        waiting on tx_rate could go, None if nothing is waiting.
+        """
+        wait: Optional[float] = None
+        quantum = self.config.scheduler_quantum
+        for cls, active in enumerate(self.active):
+            # NOTE a queue not held back by tx_rate earns a quantum a pass until it can send, so this only
+            # gives up once every queue in a row is waiting on tx_rate
+            held = 0
+            while held < len(active):
+                addr = active[0]
+                commands = self.clients[addr]
+                queue = commands.queue
+                frame = queue[0]
+                cost = len(frame) + HEADER_SZ
+                tx_delay = self.tx.delay() if self.tx is not None and frame[0] in TX_COMMANDS else 0.0
+                if tx_delay > 0:
+                    wait = tx_delay if wait is None else min(wait, tx_delay)
+                    held += 1
+                elif commands.deficit >= cost:
+                    commands.deficit -= cost
+                    queue.popleft()
+                    # NOTE a client is scheduled by its next command, it moves over when that is of the other class
+                    if not queue:
+                        active.popleft()
+                    elif (next_cls := self.classify(queue[0])) != cls:
+                        active.popleft()
+                        self.active[next_cls].append(addr)
+                        commands.deficit = quantum
+                    return (addr, frame), None
+                else:
+                    held = 0
+                active.rotate(-1)
+                commands = self.clients[active[0]]
+                # NOTE capped so a queue held back by tx_rate can't bank a burst, but never below what its next
+                # frame costs or a frame bigger than the cap would never go
+                cap = max(2 * quantum, len(commands.queue[0]) + HEADER_SZ)
+                commands.deficit = min(commands.deficit + quantum, cap)
+        return None, wait
+
+    async def run(self):
+        while True:
+            picked, wait = self.pick()
+            if picked is None:
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), wait)
+                except TimeoutError:
+                    pass
+                continue
+            addr, frame = picked
+            await self.serial.acquire(len(frame) + HEADER_SZ)
+            if self.tx is not None and frame[0] in TX_COMMANDS:
+                self.tx.take()
+            self.router.sent(addr, frame)
+            start = time.perf_counter()
+            await self.connection.send(frame)  # pyright: ignore [reportUnknownMemberType]
+            self.send_seconds.observe(time.perf_counter() - start)
+            if self.capture is not None:
+                self.capture.write(TO_DEVICE, frame)
+            self.frames.inc()
+            self.bytes.inc(len(frame))
+            commands = self.clients.get(addr)
+            if commands is not None:
+                commands.space.set()
+
+
+async def run_server(config: Config, device: DeviceConfig, fanout: Fanout, router: Router, scheduler: WriteScheduler):
+    frames = client_frames.labels(device.label)
+    frame_bytes = client_bytes.labels(device.label)
+    handoff_seconds = request_seconds.labels(device.label)
+    backfilled = backfill_sent_frames.labels(device.label)
+    client_ids = itertools.count(1)
 
-async def run_server(config: Config, connection: SerialConnection, fanout: Fanout):
     async def handler(reader: StreamReader, writer: StreamWriter):
-        addr = writer.get_extra_info("peername")
-        fanout.add(addr, writer)
+        peer = writer.get_extra_info("peername")
+        # NOTE unix socket clients have no address to tell them apart
+        addr = f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else "unix"
+        addr = f"{addr}#{next(client_ids)}"
+        # NOTE backfill is what was kept before now, later pushes reach the client as they arrive
+        joined = None if router.ring is None else router.ring.appended
+        client = fanout.add(addr, writer)
+
+        async def settle():
+            # NOTE answered by the bridge, so only once the client's commands are, or the answer would overtake theirs
+            while scheduler.queued(addr) or router.outstanding(addr):
+                try:
+                    await asyncio.wait_for(router.progress(addr), config.response_timeout)
+                except TimeoutError:
+                    router.expire(time.monotonic())
+
+        async def backfill(data: bytes):
+            await settle()
+            if router.ring is None:
+                client.put(encode_frame(bytes([PacketType.ERROR.value, ERR_CODE_UNSUPPORTED_CMD])))
+                return
+            try:
+                _, mode, value = BACKFILL_REQUEST.unpack(data)
+            except struct.error:
+                mode, value = None, 0
+            if mode == BACKFILL_COUNT:
+                pushes = router.ring.select(before=joined, count=value)
+            elif mode == BACKFILL_SECONDS:
+                pushes = router.ring.select(before=joined, since=time.monotonic() - value)
+            else:
+                client.put(encode_frame(bytes([PacketType.ERROR.value, ERR_CODE_ILLEGAL_ARG])))
+                return
+            logging.debug(f"{device.label}: {addr}: backfill of {len(pushes)} pushes")
+            for push in pushes:
+                client.put(push)
+            backfilled.inc(len(pushes))
+            client.put(encode_frame(bytes([PacketType.OK.value])))
+
+        async def request(data: bytes):
+            frames.inc()
+            frame_bytes.inc(len(data))
+            if data[0] == BACKFILL:
+                await backfill(data)
+                return
+            responses = router.cached(addr, data) if scheduler.queued(addr) == 0 else None
+            if responses is None:
+                await scheduler.submit(addr, data)
+                return
+            logging.debug(f"{device.label}: {addr}: cached response to {data}")
+            for response in responses:
+                client.put(encode_frame(response))
+
         try:
             if config.check_signature:
                 sig_test = await read_frame(reader)
                 if sig_test != SIGNATURE:
                     raise Exception(f"Invalid signature: {sig_test}")
-                await connection.send(sig_test)  # pyright: ignore [reportUnknownMemberType]
+                await request(sig_test)
             while True:
+                await client.resumed.wait()
                 data = await read_frame(reader)
                 if not data:
                     break
-                await connection.send(data)  # pyright: ignore [reportUnknownMemberType]
+                start = time.perf_counter()
+                await request(data)
+                handoff_seconds.observe(time.perf_counter() - start)
         except Exception as e:
-            logging.error(e)
+            logging.error(f"{device.label}: {addr}: {e}")
         finally:
+            scheduler.remove(addr)
             fanout.remove(addr)
             writer.close()
 
-    server = await asyncio.start_server(handler, host=config.host, port=config.port)
-    await server.serve_forever()
+    servers = [await asyncio.start_server(handler, host=device.host, port=device.port)]
+    try:
+        if device.unix_path is not None:
+            servers.append(await asyncio.start_unix_server(handler, path=device.unix_path))
+        await asyncio.Future()
+    finally:
+        # NOTE serve_forever would wait on connected clients, they go with the device
+        for server in servers:
+            server.close()
+            server.close_clients()
+
+
+async def process_frames(device: DeviceConfig, frame_q: asyncio.Queue[bytes], router: Router, capture: Optional[CaptureWriter] = None):
+    frame_queue_depth.track(frame_q.qsize, device.label)
+    pushes = device_frames.labels(device.label, "push")
+    responses = device_frames.labels(device.label, "response")
+    frame_bytes = device_bytes.labels(device.label)
+    frame_seconds = route_seconds.labels(device.label)
+    while True:
+        frame = await frame_q.get()
+        logging.debug(f"{device.label}: frame: {frame}")
+        start = time.perf_counter()
+        if capture is not None:
+            capture.write(FROM_DEVICE, frame)
+        (pushes if is_push(frame) else responses).inc()
+        frame_bytes.inc(len(frame))
+        router.route(frame)
+        frame_seconds.observe(time.perf_counter() - start)
+
+
+async def run_device(config: Config, device: DeviceConfig, ring: Optional[FrameRing] = None):
+    """
+    One device's pipeline, serial connection through to its clients. Returns
+    by raising once the device disconnects.
+    """
+    frame_q = asyncio.Queue[bytes]()
+    fanout = Fanout(config, device.label)
+    router = Router(config, device.label, fanout, ResponseCache(config, device.label) if config.cache else None, ring)
+    disconnected = asyncio.Event()
+    capture = CaptureWriter(device.capture_path) if device.capture_path is not None else None
+
+    connection = device.create_connection()
+    try:
+
+        async def disconnect_handler(reason: str):
+            logging.info(f"{device.label}: Serial Disconnected: {reason}")
+            disconnected.set()
+
+        connection.set_disconnect_callback(disconnect_handler)  # pyright: ignore [reportUnknownMemberType]
+
+        class Reader:
+            @staticmethod
+            async def handle_rx(_frame: bytes):
+                frame_q.put_nowait(_frame)
+
+        connection.set_reader(Reader())  # pyright: ignore [reportUnknownMemberType]
+        await connection.connect()
+        scheduler = WriteScheduler(config, device, connection, router, capture)
 
+        async def watch():
+            await disconnected.wait()
+            raise Exception("Serial Disconnected")
 
-async def process_frames(frame_q: asyncio.Queue[bytes], fanout: Fanout):
+        async with TaskGroup() as g:
+            g.create_task(run_server(config, device, fanout, router, scheduler))
+            g.create_task(scheduler.run())
+            g.create_task(process_frames(device, frame_q, router, capture))
+            g.create_task(watch())
+            if capture is not None:
+                g.create_task(capture.run())
+    finally:
+        await connection.disconnect()
+        if capture is not None:
+            capture.close()
+
+
+async def supervise_device(config: Config, device: DeviceConfig):
+    """
+    Keep a failed device from taking the others down, optionally retrying it.
+    Pushes kept for backfill outlive a reconnect, for clients reconnecting too.
+    """
+    ring: Optional[FrameRing] = None
+    if config.backfill_bytes > 0 and config.backfill_frames > 0:
+        ring = FrameRing(config.backfill_bytes, config.backfill_frames)
+        backfill_kept_frames.track(ring.__len__, device.label)
     while True:
-        frame = await frame_q.get()
-        logging.debug(f"frame: {frame}")
-        # TODO I don't know what the first byte is, does it matter?
-        fanout.write(b"?")
-        data_sz = len(frame).to_bytes(2, byteorder="little")
-        fanout.write(data_sz)
-        fanout.write(frame)
+        try:
+            await run_device(config, device, ring)
+        except Exception as e:
+            logging.error(f"{device.label}: {e!r}")
+        if config.reconnect_delay is None:
+            logging.error(f"{device.label}: stopped")
+            return
+        logging.info(f"{device.label}: reconnecting in {config.reconnect_delay}s")
+        await asyncio.sleep(config.reconnect_delay)
 
 
 async def amain():
@@ -147,32 +895,29 @@ async def amain():
     logging.root.setLevel(config.loglevel)
     logging.debug(f"config_data: {config_data}")
 
-    frame_q = asyncio.Queue[bytes]()
-    fanout = Fanout()
-
-    port = str(config.serial_device_path)
-    connection = SerialConnection(port, baudrate=config.baudrate)
-    try:
-
-        async def disconnect_handler(reason: str):
-            logging.info(f"Serial Disconnected: {reason}")
-            main_task.cancel()
-
-        connection.set_disconnect_callback(disconnect_handler)  # pyright: ignore [reportUnknownMemberType]
-
-        class Reader:
-            @staticmethod
-            async def handle_rx(_frame: bytes):
-                frame_q.put_nowait(_frame)
-
-        connection.set_reader(Reader())  # pyright: ignore [reportUnknownMemberType]
-        await connection.connect()
-
-        async with TaskGroup() as g:
-            g.create_task(run_server(config, connection, fanout))
-            g.create_task(process_frames(frame_q, fanout))
-    finally:
-        await connection.disconnect()
+    if not config.devices:
+        raise Exception("No devices configured")
+    if len(set(device.label for device in config.devices)) != len(config.devices):
+        raise Exception("Device names must be unique")
+    unix_paths = [device.unix_path for device in config.devices if device.unix_path is not None]
+    if len(set(unix_paths)) != len(unix_paths):
+        raise Exception("Device unix_paths must be unique")
+    if config.cache and not config.route_responses:
+        raise Exception("cache requires route_responses")
+    if config.scheduler_quantum <= 0:
+        raise Exception("scheduler_quantum must be positive")
+
+    async with TaskGroup() as g:
+        devices = [g.create_task(supervise_device(config, device)) for device in config.devices]
+        extras: list[asyncio.Task[None]] = []
+        if config.metrics_port is not None:
+            extras.append(g.create_task(serve_metrics(config.metrics_host, config.metrics_port)))
+        if config.metrics_log_interval is not None:
+            extras.append(g.create_task(log_metrics(config.metrics_log_interval)))
+        await asyncio.wait(devices)
+        logging.error("All devices stopped")
+        for task in extras:
+            task.cancel()
 
 
 def main():